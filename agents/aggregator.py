@@ -34,7 +34,7 @@ def aggregator_node(state: LaPSuMState) -> Command[Literal[END]]:
     # Skip if already finalized
     for response in state.get("agent_responses", {}).values():
         if "FINAL ANSWER" in response:
-            return Command(update=state, goto=END)
+            return Command(goto=END)
 
     # Build conversation context from agent responses
     messages = [
@@ -56,9 +56,4 @@ def aggregator_node(state: LaPSuMState) -> Command[Literal[END]]:
     goto = END if "FINAL ANSWER" in final_message.content else END  # optionally re-orchestrate if not final
 
     # Save the aggregated message
-    return Command(update={
-        "agent_responses": {
-            **state.get("agent_responses", {}),
-            "aggregator": final_message.content
-        }
-    }, goto=goto)
\ No newline at end of file
+    return Command(update={"agent_responses": {"aggregator": final_message.content}}, goto=goto)
\ No newline at end of file
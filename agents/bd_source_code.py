@@ -4,22 +4,20 @@ from langchain_core.tools import tool
 from langchain_core.messages import HumanMessage, AIMessage
 from langgraph.graph import MessagesState, END
 from langgraph.types import Command
+from common import guarded_page, agent_engine
 from .helpers import make_system_prompt
 from .common import llms, LaPSuMState
 
-from sqlalchemy import create_engine, text
 
 # ─────── Setup database engine ─────── #
-engine = create_engine("sqlite:///uml.db")  # Or your actual DB
+engine = agent_engine("uml.db")  # Or your actual DB
 
 @tool
-def query_uml_database(sql: str) -> str:
-    """Run a SQL query against the UML database. Return results as string."""
+def query_uml_database(sql: str, offset: int = 0) -> str:
+    """Run a SQL query against the UML database. Return results as a table, one page at a time from `offset`."""
     with engine.connect() as conn:
         try:
-            result = conn.execute(text(sql))
-            rows = [dict(row) for row in result]
-            return str(rows)
+            return guarded_page(conn, sql, offset)
         except Exception as e:
             return f"SQL Error: {e}"
 
@@ -28,7 +26,7 @@ SCHEMA_PROMPT = """
 You are a software architecture assistant specialized in analyzing Java projects via UML databases.
 
 You can use the following tool:
-- query_uml_database(sql): Run SQL queries on the UML database.
+- query_uml_database(sql, offset): Run SQL queries on the UML database. Results are paged; pass offset to read more rows.
 
 The UML schema consists of:
 - uml_class(id, name, package_name, is_abstract, is_interface, annotations, files, dom_id, display_name, summary, comments)
@@ -49,16 +47,17 @@ uml_agent = create_react_agent(
 )
 
 # ─────── Node for LangGraph ─────── #
-def source_code_node(state: LaPSuMState) -> Command[Literal["orchestrator"]]:
+def source_code_node(state: LaPSuMState) -> Command[Literal["aggregator"]]:
     if "source_code" in state.get("responded_agents", []):
-        return Command(update=state, goto="orchestrator")
+        return Command(goto="aggregator")
 
     query = state.get("rewritten_query") or state.get("user_query") or ""
     result = uml_agent.invoke({"messages": [HumanMessage(content=query)]})
     final_message = result["messages"][-1]
 
-    state["agent_responses"]["source_code"] = final_message.content
-    state["responded_agents"].append("source_code")
     result["messages"][-1] = AIMessage(content=final_message.content, name="source_code")
 
-    return Command(update=state, goto="orchestrator")
\ No newline at end of file
+    return Command(update={
+        "agent_responses": {"source_code": final_message.content},
+        "responded_agents": ["source_code"],
+    }, goto="aggregator")
\ No newline at end of file
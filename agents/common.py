@@ -47,6 +47,18 @@ llms = {
 from typing import List, Optional, Dict, Literal
 from typing_extensions import Annotated, TypedDict
 
+# Required agents run in parallel, so their answers are merged into the state
+# rather than overwritten; the orchestrator passes None to start a new round.
+def merge_responses(current: Optional[Dict[str, str]], update: Optional[Dict[str, str]]) -> Dict[str, str]:
+    if update is None:
+        return {}
+    return {**(current or {}), **update}
+
+def add_responded(current: Optional[List[str]], update: Optional[List[str]]) -> List[str]:
+    if update is None:
+        return []
+    return (current or []) + update
+
 class LaPSuMState(TypedDict):
     # User query and orchestration context
     user_query: Annotated[Optional[str], "Original user query"]
@@ -58,10 +70,10 @@ class LaPSuMState(TypedDict):
 
     # Agent coordination
     required_agents: Annotated[List[Literal["history", "source_code"]], "List of agents needed to process the query"]
-    responded_agents: Annotated[List[Literal["history", "source_code"]], "List of agents that have already responded"]
+    responded_agents: Annotated[List[Literal["history", "source_code"]], "List of agents that have already responded", add_responded]
 
     # Optional: store intermediate responses for aggregation
-    agent_responses: Annotated[Dict[str, str], "Responses from each agent keyed by agent name"]
+    agent_responses: Annotated[Dict[str, str], "Responses from each agent keyed by agent name", merge_responses]
 
 
     # issues_url: Annotated[Optional[str], "URL to the issue tracker (e.g., GitHub issues)"]
@@ -1,5 +1,4 @@
-import os
-import subprocess
+import logging
 from typing import Literal
 from langchain_core.tools import tool
 from langchain_core.messages import HumanMessage, AIMessage
@@ -7,7 +6,11 @@ from langchain_core.messages import HumanMessage, AIMessage
 from langgraph.prebuilt import create_react_agent
 from langgraph.graph import MessagesState, END
 from langgraph.types import Command
+from common import guarded_page, agent_engine
 from .helpers import  make_system_prompt
+from history_index import update_history_index
+from git_backend import read_object_page, git_command_output
+from change_impact import method_impact
 from .common import llms, LaPSuMState
 
 @tool
@@ -22,24 +25,40 @@ def run_git_command(repo_path: str, command: str) -> str:
     Returns:
         The output of the command or an error message.
     """
-    if not os.path.exists(os.path.join(repo_path, ".git")):
-        return f"Error: {repo_path} is not a valid Git repository."
+    return git_command_output(repo_path, command)
 
-    try:
-        result = subprocess.run(
-            ["git"] + command.strip().split(),
-            cwd=repo_path,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        return f"Error running git command: {e.stderr}"
+# The git history index (see history_index.py) is attached to the agents' engine of the UML data
+history_engine = agent_engine("uml-data.db")
+
+@tool
+def query_git_history(sql: str, offset: int = 0) -> str:
+    """Run a SQL query against the indexed git history. Return results as a table, one page at a time from `offset`."""
+    with history_engine.connect() as conn:
+        try:
+            return guarded_page(conn, sql, offset)
+        except Exception as e:
+            return f"SQL Error: {e}"
+
+@tool
+def read_git_object(repo_path: str, revision: str, path: str = "", offset: int = 0) -> str:
+    """
+    Read a git object: a commit with its full message, a tree listing, or the
+    contents of `path` at `revision`. Returns one page of lines from `offset`.
+    """
+    return read_object_page(repo_path, revision, path, offset)
+
+@tool
+def methods_changed(repo_path: str, revisions: str) -> str:
+    """
+    The UML methods and classes (uml_method.id, uml_class.id) whose source
+    lines the commits in `revisions` changed, e.g. 'HEAD~10..HEAD' or
+    'v1.0..v2.0', with how many commits and hunks touched each.
+    """
+    return method_impact(repo_path, revisions)
 
 history_agent = create_react_agent(
     llms['history'],
-    tools=[run_git_command],
+    tools=[query_git_history, read_git_object, methods_changed, run_git_command],
     prompt=make_system_prompt("""
         You are a version control analysis assistant collaborating with a software researcher.
         
@@ -50,18 +69,37 @@ history_agent = create_react_agent(
         - All information must be derived from Git history via the provided tools.
         - Begin your final answer with 'FINAL ANSWER'.
 
-        Available Tool:
-        - run_git_command(command): Run any git command against the local repo.
+        Available Tools:
+        - query_git_history(sql, offset): SQL over the indexed history, answers in milliseconds. Prefer it.
+          Results are paged; pass offset to read more rows. Tables:
+          - git_commit(sha, parents, author_name, author_email, authored_at, committed_at, subject)
+          - git_file_change(id, sha, path, old_path, added, deleted): one row per file a commit touched;
+            old_path is set for renames, added/deleted are NULL for binary files
+          - git_file_churn(path, commits, added, deleted, authors, first_committed_at, last_committed_at)
+          - uml_class_churn(class_id, commits, authors, added, deleted, churned, first_committed_at,
+            last_committed_at): the same per UML class (join uml_class.id), over the class's source files
+          Times are unix seconds: use datetime(committed_at, 'unixepoch').
+        - read_git_object(revision, path, offset): A commit's full message, a tree listing, or a file's
+          contents at a revision, paged by lines. Use it instead of git show.
+        - methods_changed(revisions): The uml_method/uml_class ids whose lines a commit range changed,
+          from the diff hunks. Use it for which methods or classes a change touched instead of reading diffs.
+        - run_git_command(command): Run any git command against the local repo, for what the index
+          does not hold (diff contents, blame).
 
         Always refer to the repo using the path provided in 'repo_path'.
     """)
 )
-def history_node(state: LaPSuMState) -> Command[Literal["orchestrator"]]:
+def history_node(state: LaPSuMState) -> Command[Literal["aggregator"]]:
     if "history" in state.get("responded_agents", []):
-        return Command(update=state, goto="orchestrator")
+        return Command(goto="aggregator")
 
     query = state.get("rewritten_query") or state.get("user_query") or ""
     repo_path = state.get("repo_path")
+    if repo_path:
+        try:
+            update_history_index(repo_path)
+        except Exception as e:
+            logging.warning("Could not index the git history of %s: %s", repo_path, e)
 
     # Pass the rewritten query and repo_path to the agent
     result = history_agent.invoke({
@@ -70,10 +108,11 @@ def history_node(state: LaPSuMState) -> Command[Literal["orchestrator"]]:
     })
 
     final_message = result["messages"][-1]
-    state["agent_responses"]["history"] = final_message.content
-    state["responded_agents"].append("history")
 
     # Tag the message so it's traceable in logs or UI
     result["messages"][-1] = AIMessage(content=final_message.content, name="history")
 
-    return Command(update=state, goto="orchestrator")
\ No newline at end of file
+    return Command(update={
+        "agent_responses": {"history": final_message.content},
+        "responded_agents": ["history"],
+    }, goto="aggregator")
\ No newline at end of file
@@ -1,13 +1,13 @@
 import json
 from typing import Literal
 from langchain_core.messages import  HumanMessage
-from langgraph.types import Command
+from langgraph.types import Command, Send
 from .common import llms, LaPSuMState
 
 def orchestrator_node(state: LaPSuMState) -> Command[Literal["history", "source_code", "aggregator"]]:
     # Skip orchestration if aggregation is already triggered or all agents have responded
-    if state.get("user_query") is None or set(state.get("required_agents", [])) == set(state.get("responded_agents", [])):
-        return Command(update=state, goto="aggregator")
+    if state.get("user_query") is None or (state.get("required_agents") and set(state["required_agents"]) == set(state.get("responded_agents", []))):
+        return Command(goto="aggregator")
 
     # Run LLM-based query rewriting and planning
     task_analysis = llms['orchestrator'].invoke([
@@ -34,25 +34,22 @@ def orchestrator_node(state: LaPSuMState) -> Command[Literal["history", "source_
 
     parsed_response = json.loads(task_analysis.content)
 
-    # Extract orchestration fields
-    state["rewritten_query"] = parsed_response.get("rewritten_query", state["user_query"])
-    state["required_agents"] = parsed_response.get("required_agents", [])
-    state["responded_agents"] = []
-    state["agent_responses"] = {}
-
-    # Optional: add the plan to message history so agents can reason over it
-    plan = parsed_response.get("plan")
-    if plan:
-        plan_message = HumanMessage(content=f"Plan:\n{plan}", name="planner")
-        state["messages"] = [plan_message] + state.get("messages", [])
+    # Extract orchestration fields; None clears the previous round's responses
+    update = {
+        "rewritten_query": parsed_response.get("rewritten_query", state["user_query"]),
+        "required_agents": parsed_response.get("required_agents", []),
+        "responded_agents": None,
+        "agent_responses": None,
+    }
 
     # If no agents are required, go to aggregator
-    if not state["required_agents"]:
-        return Command(update=state, goto="aggregator")
+    if not update["required_agents"]:
+        return Command(update=update, goto="aggregator")
 
-    # Route to first required agent
-    next_agent = state["required_agents"][0]
-    return Command(update=state, goto=next_agent)
+    # Dispatch every required agent at once; they all return to the aggregator,
+    # which runs once the slowest of them has answered
+    task = {**state, **update, "responded_agents": [], "agent_responses": {}}
+    return Command(update=update, goto=[Send(agent, task) for agent in update["required_agents"]])
 
 # def orchestrator_node(state: MessagesState) -> Command[Literal["history", END]]:
 #     for msg in state["messages"]:
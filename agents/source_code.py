@@ -44,10 +44,10 @@ source_code_agent = create_react_agent(
     """),
 )
 
-def source_code_node(state: LaPSuMState) -> Command[Literal["orchestrator"]]:
+def source_code_node(state: LaPSuMState) -> Command[Literal["aggregator"]]:
     # Skip processing if already responded
     if "source_code" in state.get("responded_agents", []):
-        return Command(update=state, goto="orchestrator")
+        return Command(goto="aggregator")
 
     query = state.get("rewritten_query") or state.get("user_query") or ""
 
@@ -55,10 +55,11 @@ def source_code_node(state: LaPSuMState) -> Command[Literal["orchestrator"]]:
 
     # Extract the latest message
     final_message = result["messages"][-1]
-    state["agent_responses"]["source_code"] = final_message.content
-    state["responded_agents"].append("source_code")
 
     # Optionally tag the message
     result["messages"][-1] = AIMessage(content=final_message.content, name="source_code")
 
-    return Command(update=state, goto="orchestrator")
\ No newline at end of file
+    return Command(update={
+        "agent_responses": {"source_code": final_message.content},
+        "responded_agents": ["source_code"],
+    }, goto="aggregator")
\ No newline at end of file
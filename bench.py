@@ -0,0 +1,367 @@
+"""
+Benchmarks and regression checks for the diagram data layer.
+
+Generates a synthetic UML database shaped like the ones produced by the
+extractor, points `model` at it and checks the endpoints' query budget.
+
+    python bench.py --packages 40 --classes 50
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import orjson
+from sqlalchemy import create_engine, event, inspect
+
+import change_impact
+import model
+import snapshot
+
+# Tables written by the extractor; everything else in the schema is derived
+EXTRACTOR_TABLES = [
+    model.UMLClass.__table__, model.UMLProperty.__table__, model.UMLMethod.__table__,
+    model.UMLParameter.__table__, model.UMLPackage.__table__,
+]
+# uml_relationship as the extractor writes it: source_id/target_id are added by model.migrate_schema
+EXTRACTOR_RELATIONSHIP_TABLE = (
+    "CREATE TABLE uml_relationship ("
+    "id INTEGER NOT NULL PRIMARY KEY, source VARCHAR, target VARCHAR, name VARCHAR, type VARCHAR)"
+)
+# get_classes: rollup state, classes, properties, methods, parameters, relationships
+MAX_GET_CLASSES_QUERIES = 6
+# get_packages: rollup state, classes, subpackages, grandchildren probe, rollup edges
+MAX_GET_PACKAGES_QUERIES = 5
+
+
+def generate_db(path: str, packages: int = 20, classes: int = 30, members: int = 6, seed: int = 7):
+    """
+    Write a synthetic UML database to `path`: `packages` leaf packages spread
+    over five org.bench.gN groups, each leaf with `classes` classes (groups get
+    half as many), `members` properties and methods per class and two
+    parameters per method, plus random class-level relationships.
+
+    Like the extractor's output the database has no indexes, no derived
+    tables or columns and user_version 0; `model.migrate_schema` adds them.
+    """
+    rnd = random.Random(seed)
+    engine = create_engine(f"sqlite:///{path}")
+    model.Base.metadata.create_all(engine, tables=EXTRACTOR_TABLES)
+    for table in EXTRACTOR_TABLES:
+        for index in table.indexes:
+            index.drop(engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql(EXTRACTOR_RELATIONSHIP_TABLE)
+
+    package_rows = [{"name": "org", "parent": None}, {"name": "bench", "parent": "org"}]
+    package_sizes = []
+    for p in range(packages):
+        group = f"org.bench.g{p % 5}"
+        if p < 5:
+            package_rows.append({"name": f"g{p}", "parent": "org.bench"})
+            package_sizes.append((group, classes // 2))
+        package_rows.append({"name": f"p{p}", "parent": group})
+        package_sizes.append((f"{group}.p{p}", classes))
+
+    class_rows, property_rows, method_rows, parameter_rows = [], [], [], []
+    fqcns = []
+    class_id = method_id = 0
+    for package_name, package_classes in package_sizes:
+        for c in range(package_classes):
+            class_id += 1
+            name = f"Class{c}"
+            fqcns.append(f"{package_name}.{name}")
+            class_rows.append({
+                "id": class_id, "name": name, "package_name": package_name,
+                "is_abstract": c % 7 == 0, "is_interface": c % 11 == 0,
+                "files": f'["src/main/java/{package_name.replace(".", "/")}/{name}.java"]',
+            })
+            for m in range(members):
+                property_rows.append({
+                    "class_id": class_id, "name": f"field{m}", "data_type": "String",
+                    "visibility": "private", "is_static": False, "is_final": m % 2 == 0,
+                })
+                method_id += 1
+                method_rows.append({
+                    "id": method_id, "class_id": class_id, "name": f"method{m}", "return_type": "void",
+                    "visibility": "public", "is_static": False, "is_abstract": False,
+                    "starting_line": 10 + m * 12, "ending_line": 20 + m * 12,
+                    "source": "{ return; }" * 20,
+                })
+                for a in range(2):
+                    parameter_rows.append({
+                        "method_id": method_id, "name": f"arg{a}", "data_type": "int",
+                        "annotations": '["@NotNull"]' if a else None,
+                    })
+
+    relationship_rows = [
+        {"source": rnd.choice(fqcns), "target": rnd.choice(fqcns),
+         "name": "uses", "type": rnd.choice(["association", "composition", "inheritance"])}
+        for _ in range(len(fqcns) * 2)
+    ]
+
+    with engine.begin() as conn:
+        conn.execute(model.UMLPackage.__table__.insert(), package_rows)
+        conn.execute(model.UMLClass.__table__.insert(), class_rows)
+        conn.execute(model.UMLProperty.__table__.insert(), property_rows)
+        conn.execute(model.UMLMethod.__table__.insert(), method_rows)
+        conn.execute(model.UMLParameter.__table__.insert(), parameter_rows)
+        conn.execute(model.UMLRelationship.__table__.insert(), relationship_rows)
+    engine.dispose()
+
+
+def use_database(path: str):
+    """Rebind `model` to the database at `path` and return its engine."""
+    engine = create_engine(f"sqlite:///{path}")
+    model.engine = engine
+    model.Session.configure(bind=engine)
+    return engine
+
+
+@contextmanager
+def count_queries(engine):
+    """Count the SQL statements sent through `engine` inside the block."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def timed(fn, *args, repeat: int = 5):
+    """Best-of-`repeat` wall time of fn(*args) in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def endpoint_timings(package_name: str, group_name: str):
+    return {
+        f"get_classes({package_name!r})": timed(model.get_classes, package_name),
+        "get_classes(None)": timed(model.get_classes, None, repeat=2),
+        "get_classes(None, fields='id,name')": timed(model.get_classes, None, None, None, "id,name", repeat=2),
+        "get_classes(None, limit=100)": timed(model.get_classes, None, 100),
+        f"get_packages({group_name!r})": timed(model.get_packages, group_name),
+        "get_packages(None)": timed(model.get_packages, None),
+    }
+
+
+def check_migration(engine):
+    """migrate_schema must bring an extractor database to the current schema, relationships linked."""
+    inspector = inspect(engine)
+    columns = {column["name"] for column in inspector.get_columns("uml_relationship")}
+    assert {"source_id", "target_id"} <= columns, "migrate_schema did not add the relationship class ids"
+    indexes = {index["name"] for table in inspector.get_table_names() for index in inspector.get_indexes(table)}
+    missing = {index.name for table in model.Base.metadata.sorted_tables if table.name in inspector.get_table_names()
+               for index in table.indexes} - indexes
+    assert not missing, f"migrate_schema did not create {sorted(missing)}"
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA user_version").scalar() == len(model.MIGRATIONS)
+        unlinked = conn.exec_driver_sql(
+            "SELECT count(*) FROM uml_relationship r JOIN uml_class c ON r.source = c.package_name || '.' || c.name "
+            "WHERE r.source_id IS NOT c.id"
+        ).scalar()
+    assert not unlinked, f"{unlinked} relationships not linked to their source class"
+
+
+def drop_indexes(engine):
+    """Drop every index of the UML tables, leaving the migrated columns and user_version alone."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in inspector.get_table_names():
+            for index in inspector.get_indexes(table):
+                conn.exec_driver_sql(f"DROP INDEX {index['name']}")
+
+
+def check_get_classes_query_count(engine, package_name: str):
+    """get_classes must not issue per-class lazy loads."""
+    model.get_classes(package_name)  # links relationships on first use
+    for pkg in (package_name, None):
+        with count_queries(engine) as statements:
+            model.get_classes(pkg)
+        assert len(statements) <= MAX_GET_CLASSES_QUERIES, (
+            f"get_classes({pkg!r}) issued {len(statements)} queries, budget is {MAX_GET_CLASSES_QUERIES}"
+        )
+        print(f"get_classes({pkg!r}): {len(statements)} queries")
+
+
+def check_get_packages_query_count(engine, package_name: str):
+    """get_packages must answer from the rollup, not by scanning relationships."""
+    for pkg in (package_name, None):
+        with count_queries(engine) as statements:
+            model.get_packages(pkg)
+        assert len(statements) <= MAX_GET_PACKAGES_QUERIES, (
+            f"get_packages({pkg!r}) issued {len(statements)} queries, budget is {MAX_GET_PACKAGES_QUERIES}"
+        )
+        assert not any("uml_relationship" in s for s in statements), "get_packages scanned uml_relationship"
+        print(f"get_packages({pkg!r}): {len(statements)} queries")
+
+
+def peak_memory_mb(fn, *args):
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def dump_all_classes():
+    return orjson.dumps(model.get_classes(None))
+
+
+def stream_all_classes():
+    for kind, item in model.iter_classes(None):
+        orjson.dumps({kind: item})
+
+
+def diagram_rows(path: str = "data/class-diagram.json", copies: int = 200):
+    """
+    data/class-diagram.json repeated `copies` times, with the columns the
+    database stores as JSON text (class files, parameter annotations) turned
+    back into text, the way get_classes reads them.
+    """
+    with open(path) as f:
+        diagram = json.load(f)
+    classes = []
+    for copy in range(copies):
+        for cls in diagram["classes"]:
+            methods = [
+                {**method, "parameters": [{**param, "annotations": json.dumps(param["annotations"])} for param in method["parameters"]]}
+                for method in cls["methods"]
+            ]
+            classes.append({**cls, "id": f"{cls['id']}{copy}", "files": json.dumps(cls["files"]), "methods": methods})
+    return {"type": "class", "classes": classes, "relationships": diagram["relationships"] * copies}
+
+
+def render(rows, parse_json):
+    """Build the /data/classes payload from `rows`, reading stored JSON columns with `parse_json`."""
+    return {
+        "type": "class",
+        "classes": [
+            {**cls, "files": parse_json(cls["files"]), "methods": [
+                {**method, "parameters": [{**param, "annotations": parse_json(param["annotations"])} for param in method["parameters"]]}
+                for method in cls["methods"]
+            ]}
+            for cls in rows["classes"]
+        ],
+        "relationships": rows["relationships"],
+    }
+
+
+def serialization_timings(rows):
+    from fastapi.encoders import jsonable_encoder
+    compact = {"ensure_ascii": False, "separators": (",", ":")}
+    paths = {
+        "jsonable_encoder + json.dumps": lambda: json.dumps(jsonable_encoder({"data": render(rows, json.loads)}), **compact).encode("utf-8"),
+        "json.loads + json.dumps": lambda: json.dumps({"data": render(rows, json.loads)}, **compact).encode("utf-8"),
+        "orjson, stored JSON spliced raw": lambda: orjson.dumps({"data": render(rows, model.stored_json)}),
+    }
+    bodies = {label: encode() for label, encode in paths.items()}
+    assert len(set(bodies.values())) == 1, "serialization paths disagree"
+    return {label: timed(encode) for label, encode in paths.items()}, len(next(iter(bodies.values())))
+
+
+def method_lookup_timings(hunks: int = 2000, seed: int = 7):
+    """Hunk -> method lookups through the per-file interval trees against a scan of every method range."""
+    start = time.perf_counter()
+    with model.Session() as session:
+        index = change_impact.MethodIndex(session)
+    build = (time.perf_counter() - start) * 1000
+    ranges = [
+        (path, start, end, method_id)
+        for path, tree in index.files.items() for start, end, method_id in tree.items
+    ]
+    rnd = random.Random(seed)
+    paths = list(index.files)
+    queries = []
+    for _ in range(hunks):
+        line = rnd.randint(1, 100)
+        queries.append((paths[rnd.randrange(len(paths))].split("/", 3)[-1], line, line + rnd.randint(0, 5)))
+
+    def indexed():
+        return [sorted(m for tree in index.trees(path) for m in tree.overlapping(lo, hi)) for path, lo, hi in queries]
+
+    def scanned():
+        return [
+            sorted(m for stored, start, end, m in ranges if stored.endswith("/" + path) and start <= hi and end >= lo)
+            for path, lo, hi in queries
+        ]
+
+    assert indexed() == scanned(), "interval index and scan disagree"
+    return build, timed(indexed), timed(scanned, repeat=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packages", type=int, default=20)
+    parser.add_argument("--classes", type=int, default=30)
+    parser.add_argument("--members", type=int, default=6)
+    args = parser.parse_args()
+
+    timings, size = serialization_timings(diagram_rows())
+    print(f"{f'serializing {size / 2**20:.1f} MB of class diagram':<40} {'time':>12}")
+    for label, ms in timings.items():
+        print(f"{label:<40} {ms:9.2f} ms")
+    print()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "uml-bench.db")
+        generate_db(path, args.packages, args.classes, args.members)
+        baseline = os.path.join(tmp, "uml-bench-baseline.db")
+        shutil.copyfile(path, baseline)
+        engine = use_database(path)
+        sample_package = "org.bench.g0.p0"
+
+        start = time.perf_counter()
+        model.migrate_schema(engine)
+        print(f"migrate_schema on the extractor's schema: {(time.perf_counter() - start) * 1000:.0f} ms")
+        check_migration(engine)
+        check_get_classes_query_count(engine, sample_package)
+        check_get_packages_query_count(engine, "org.bench")
+        after = endpoint_timings(sample_package, "org.bench.g0")
+
+        # Same data without the migration's indexes (the extractor's database cannot be served unmigrated)
+        engine.dispose()
+        engine = use_database(baseline)
+        model.migrate_schema(engine)
+        drop_indexes(engine)
+        model.get_classes(sample_package)  # builds the package rollup outside the timings
+        before = endpoint_timings(sample_package, "org.bench.g0")
+        engine.dispose()
+        engine = use_database(path)
+
+        print(f"\n{'':<40} {'no indexes':>12} {'migrated':>12}")
+        for label in before:
+            print(f"{label:<40} {before[label]:9.2f} ms {after[label]:9.2f} ms")
+
+        print(f"\n{'snapshots':<40} {'live':>12} {'snapshot':>12}")
+        start = time.perf_counter()
+        count = snapshot.build_snapshots()
+        print(f"{f'build ({count} payloads)':<40} {'':>12} {(time.perf_counter() - start) * 1000:9.0f} ms")
+        for endpoint, fn, pkg in (("classes", model.get_classes, sample_package), ("classes", model.get_classes, None),
+                                  ("packages", model.get_packages, "org.bench.g0")):
+            live = timed(lambda: snapshot.encode_payload(fn(pkg)), repeat=2)
+            stored = timed(snapshot.load_snapshot, endpoint, pkg)
+            print(f"{f'{endpoint}({pkg!r})':<40} {live:9.2f} ms {stored:9.2f} ms")
+
+        build, indexed, scanned = method_lookup_timings()
+        print(f"\n{'diff hunk -> method (2000 hunks)':<40} {'scan':>12} {'interval':>12}")
+        print(f"{f'lookups (index built in {build:.0f} ms)':<40} {scanned:9.2f} ms {indexed:9.2f} ms")
+
+        print(f"\n{'whole-repository dump, peak memory':<40} {'get_classes':>12} {'iter_classes':>12}")
+        print(f"{'':<40} {peak_memory_mb(dump_all_classes):9.1f} MB {peak_memory_mb(stream_all_classes):9.1f} MB")
+        engine.dispose()
@@ -0,0 +1,229 @@
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Size-bounded LRU of encoded response bodies.
+
+    Keys carry the database version stamp, so entries for an older version are
+    never served; they simply age out of the LRU.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def etag(endpoint: str, args: tuple, version: str) -> str:
+        digest = hashlib.blake2b(f"{endpoint}|{args!r}|{version}".encode(), digest_size=12)
+        return f'"{digest.hexdigest()}"'
+
+    def get(self, key):
+        body = self.entries.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def put(self, key, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = body
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """True if an If-None-Match header value matches `etag` (weak comparison)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """True if an Accept-Encoding header value allows `encoding` (q=0 refuses it)."""
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.partition(";")
+        if name.strip().lower() in (encoding, "*"):
+            return params.replace(" ", "").lower() not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def normalize_question(text: str) -> str:
+    """Case, whitespace and trailing punctuation do not make a different question."""
+    return " ".join((text or "").lower().split()).rstrip("?.! ")
+
+
+class AnswerCache:
+    """
+    Persistent question -> answer cache for the SQL agent, in its own SQLite
+    file so that writing to it never changes the UML database version.
+
+    Entries are keyed by the normalized question and context and remember the
+    database version they were answered on, the last SQL the agent ran and that
+    SQL's result. After the database changes, an entry is still served if
+    re-running its SQL gives the same result. Entries expire `ttl` seconds
+    after they were answered; beyond `max_entries` the least recently used go.
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 3600, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def connection(self) -> sqlite3.Connection:
+        """The cache file, opened (and created) on first use; call with the lock held."""
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answer ("
+                " key TEXT PRIMARY KEY, question TEXT, db_version TEXT, sql TEXT, result TEXT,"
+                " answer TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_answer_last_used ON answer (last_used)")
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+    @staticmethod
+    def key(question: str, context: str) -> str:
+        text = f"{normalize_question(question)}\0{' '.join((context or '').split())}"
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def get(self, question: str, context: str, version: str, rerun=None):
+        """
+        The cached answer, or None. `rerun(sql)` is called to revalidate an
+        entry answered on another database version; without it such entries miss.
+        """
+        key = self.key(question, context)
+        now = time.time()
+        with self.lock:
+            row = self.connection().execute(
+                "SELECT db_version, sql, result, answer, created_at FROM answer WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or now - row[4] > self.ttl:
+            self.misses += 1
+            return None
+        entry_version, sql, result, answer, _ = row
+        if entry_version != version:
+            if rerun is None or not sql or rerun(sql) != result:
+                self.misses += 1
+                return None
+        with self.lock:
+            self.connection().execute("UPDATE answer SET db_version = ?, last_used = ? WHERE key = ?", (version, now, key))
+            self.conn.commit()
+        self.hits += 1
+        return answer
+
+    def put(self, question: str, context: str, version: str, sql, result, answer: str):
+        now = time.time()
+        with self.lock:
+            conn = self.connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO answer VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.key(question, context), normalize_question(question), version, sql, result, answer, now, now)
+            )
+            conn.execute("DELETE FROM answer WHERE created_at < ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM answer WHERE key IN (SELECT key FROM answer ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            conn.commit()
+
+
+class GitCommandCache:
+    """
+    Persistent cache of git command output, in its own SQLite file.
+
+    Keys carry the repository, a stamp of its refs and the normalized command
+    (see git_backend.git_command_output), so output recorded before a ref
+    moved is never served; it simply ages out. Beyond `max_bytes` of stored
+    output the least recently used entries go.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = None
+        self.size = 0
+
+    def connection(self) -> sqlite3.Connection:
+        """The cache file, opened (and created) on first use; call with the lock held."""
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS git_output ("
+                " key TEXT PRIMARY KEY, repo TEXT, command TEXT, output TEXT NOT NULL,"
+                " size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_git_output_last_used ON git_output (last_used)")
+            conn.commit()
+            self.conn = conn
+            self.size = self.stored_bytes()
+        return self.conn
+
+    @staticmethod
+    def key(repo: str, refs: str, command: str) -> str:
+        text = f"{repo}\0{refs}\0{' '.join(command.split())}"
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def stored_bytes(self) -> int:
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM git_output").fetchone()[0]
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.connection().execute("SELECT output FROM git_output WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE git_output SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        self.hits += 1
+        return row[0]
+
+    def put(self, key: str, repo: str, command: str, output: str):
+        size = len(output.encode())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.connection().execute("SELECT size FROM git_output WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO git_output VALUES (?, ?, ?, ?, ?, ?)",
+                (key, repo, " ".join(command.split()), output, size, time.time())
+            )
+            self.size += size - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                # Other processes may share the file; evict against what is really stored
+                self.size = self.stored_bytes()
+                while self.size > self.max_bytes:
+                    oldest, evicted = self.conn.execute(
+                        "SELECT key, size FROM git_output ORDER BY last_used LIMIT 1"
+                    ).fetchone()
+                    self.conn.execute("DELETE FROM git_output WHERE key = ?", (oldest,))
+                    self.size -= evicted
+            self.conn.commit()
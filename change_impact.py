@@ -0,0 +1,238 @@
+"""
+Which UML methods and classes a range of commits changed.
+
+Method line ranges (uml_method.starting_line/ending_line) are indexed per
+source file (uml_class.files) in interval trees, and the hunks of
+`git log -p -U0 <revisions>` are streamed through them, so a change-impact
+question is one deterministic lookup instead of the LLM reading diffs.
+
+Line ranges are those of the sources the UML data was extracted from, and
+hunks are matched on their new-side lines: exact for commits up to the
+extracted revision's state, approximate for older ones whose lines have
+since moved.
+
+    python change_impact.py /path/to/repo HEAD~10..HEAD
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+
+from sqlalchemy import select
+
+from git_backend import GitError
+from model import UMLClass, UMLMethod, Session, db_version
+
+# Rows in the formatted answer handed to the agent
+IMPACT_MAX_ROWS = 50
+HUNK_HEADER = re.compile(rb"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class IntervalIndex:
+    """
+    Static interval tree over closed ranges (start, end, value): the ranges
+    sorted by start form an implicit balanced tree, each node also holding
+    the largest end in its subtree, so subtrees ending before a query are
+    skipped whole.
+    """
+
+    def __init__(self, intervals):
+        self.items = sorted(intervals, key=lambda item: (item[0], item[1]))
+        self.max_end = [0] * len(self.items)
+        self.build(0, len(self.items) - 1)
+
+    def build(self, low: int, high: int) -> int:
+        if low > high:
+            return -1
+        mid = (low + high) // 2
+        self.max_end[mid] = max(self.items[mid][1], self.build(low, mid - 1), self.build(mid + 1, high))
+        return self.max_end[mid]
+
+    def overlapping(self, start: int, end: int) -> list:
+        """Values of the ranges with range.start <= end and range.end >= start."""
+        found, stack = [], [(0, len(self.items) - 1)]
+        while stack:
+            low, high = stack.pop()
+            if low > high:
+                continue
+            mid = (low + high) // 2
+            if self.max_end[mid] < start:
+                continue
+            stack.append((low, mid - 1))
+            item_start, item_end, value = self.items[mid]
+            if item_start <= end:
+                if item_end >= start:
+                    found.append(value)
+                stack.append((mid + 1, high))
+        return found
+
+
+class MethodIndex:
+    """Interval trees of method line ranges, one per source file, with the methods' and classes' names."""
+
+    def __init__(self, session):
+        ranges, self.methods, self.classes = {}, {}, {}
+        class_files = {}
+        for class_id, name, package_name, files in session.execute(
+            select(UMLClass.id, UMLClass.name, UMLClass.package_name, UMLClass.files)
+        ):
+            self.classes[class_id] = f"{package_name}.{name}" if package_name else name
+            try:
+                class_files[class_id] = [path.replace("\\", "/") for path in json.loads(files or "[]")]
+            except ValueError:
+                class_files[class_id] = []
+        for method_id, class_id, name, starting_line, ending_line in session.execute(
+            select(UMLMethod.id, UMLMethod.class_id, UMLMethod.name, UMLMethod.starting_line, UMLMethod.ending_line)
+            .where(UMLMethod.starting_line.is_not(None), UMLMethod.ending_line.is_not(None))
+        ):
+            self.methods[method_id] = (class_id, name)
+            for path in class_files.get(class_id, ()):
+                ranges.setdefault(path, []).append((starting_line, ending_line, method_id))
+        self.files = {path: IntervalIndex(intervals) for path, intervals in ranges.items()}
+        # Stored paths may be absolute or relative to another root; diff paths are matched as suffixes
+        self.by_name = {}
+        for path in self.files:
+            self.by_name.setdefault(path.rsplit("/", 1)[-1], []).append(path)
+
+    def trees(self, repo_path: str):
+        """The interval trees of the indexed files whose path ends with the repository path `repo_path`."""
+        return [
+            self.files[path] for path in self.by_name.get(repo_path.rsplit("/", 1)[-1], ())
+            if path == repo_path or path.endswith("/" + repo_path)
+        ]
+
+
+method_indexes = {}
+method_indexes_lock = threading.Lock()
+
+def method_index() -> MethodIndex:
+    """The MethodIndex of the UML database, rebuilt when the database changes."""
+    version = db_version()
+    with method_indexes_lock:
+        index = method_indexes.get(version)
+        if index is None:
+            with Session() as session:
+                index = MethodIndex(session)
+            method_indexes.clear()
+            method_indexes[version] = index
+    return index
+
+
+def diff_path(line: bytes) -> str:
+    path = line[4:].rstrip(b"\n").decode("utf-8", "replace")
+    if path.startswith('"') and path.endswith('"'):
+        path = path[1:-1]
+    return None if path == "/dev/null" else path.split("/", 1)[1]
+
+
+def diff_hunks(repo_path: str, revisions: str):
+    """
+    Stream (commit, path, start, end) for every hunk of the commits in
+    `revisions`: the new-side lines a hunk replaced or added, or for a pure
+    deletion the gap it left (start = end + 1), in the file's new path (the
+    old one if the file was deleted).
+    """
+    process = subprocess.Popen(
+        ["git", "-c", "core.quotePath=false", "log", "-p", "-U0", "-M", "--no-color", "--no-ext-diff",
+         "--format=%x1e%H", revisions, "--"],
+        cwd=repo_path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    commit = old_path = new_path = None
+    # "--- "/"+++ " are file names only in a file's header: in a hunk they are a removed "-- " or added "++ " line
+    in_header = False
+    for line in process.stdout:
+        if line.startswith(b"\x1e"):
+            commit, in_header = line[1:].strip().decode(), False
+        elif line.startswith(b"diff --git "):
+            old_path = new_path = None
+            in_header = True
+        elif in_header and line.startswith(b"--- "):
+            old_path = diff_path(line)
+        elif in_header and line.startswith(b"+++ "):
+            new_path = diff_path(line)
+        elif line.startswith(b"@@"):
+            in_header = False
+            match = HUNK_HEADER.match(line)
+            if not match:
+                continue
+            old_start, old_count, new_start, new_count = match.groups()
+            if new_path is None:
+                start, count = int(old_start), int(old_count if old_count is not None else 1)
+                yield commit, old_path, start, start + max(count, 1) - 1
+            else:
+                start, count = int(new_start), int(new_count if new_count is not None else 1)
+                # "+c,0" deletes lines after line c: only a method spanning lines c and c+1 lost them
+                yield commit, new_path, start if count else start + 1, start + count - 1
+    if process.wait() != 0:
+        raise GitError(f"git log {revisions} failed in {repo_path}")
+
+
+def changed_methods(repo_path: str, revisions: str) -> dict:
+    """
+    The uml_method and uml_class rows touched by the commits in `revisions`
+    (anything `git log` accepts, e.g. "HEAD~10..HEAD"): per method the
+    commits and hunks that touched it, plus the changed files that match no
+    indexed source file.
+    """
+    index = method_index()
+    methods, commits, unmatched = {}, set(), set()
+    for commit, path, start, end in diff_hunks(repo_path, revisions):
+        commits.add(commit)
+        trees = index.trees(path)
+        if not trees:
+            unmatched.add(path)
+            continue
+        for tree in trees:
+            for method_id in tree.overlapping(start, end):
+                entry = methods.setdefault(method_id, {"commits": set(), "hunks": 0})
+                entry["commits"].add(commit)
+                entry["hunks"] += 1
+    rows = []
+    for method_id, entry in methods.items():
+        class_id, name = index.methods[method_id]
+        rows.append({
+            "method_id": method_id, "class_id": class_id, "class": index.classes.get(class_id), "method": name,
+            "commits": sorted(entry["commits"]), "hunks": entry["hunks"],
+        })
+    rows.sort(key=lambda row: (-len(row["commits"]), -row["hunks"], row["method_id"]))
+    return {
+        "commits": len(commits),
+        "methods": rows,
+        "class_ids": sorted({row["class_id"] for row in rows}),
+        "unmatched_files": sorted(unmatched),
+    }
+
+
+def format_impact(impact: dict, max_rows: int = IMPACT_MAX_ROWS) -> str:
+    """changed_methods as a "col | col" table for the agent, cut at `max_rows`."""
+    lines = [
+        f"{impact['commits']} commits changed {len(impact['methods'])} methods in {len(impact['class_ids'])} classes",
+        "method_id | class_id | class | method | commits | hunks",
+    ]
+    for row in impact["methods"][:max_rows]:
+        lines.append(f"{row['method_id']} | {row['class_id']} | {row['class']} | {row['method']} | {len(row['commits'])} | {row['hunks']}")
+    if len(impact["methods"]) > max_rows:
+        lines.append(f"(+{len(impact['methods']) - max_rows} more methods, touched by fewer commits)")
+    if impact["unmatched_files"]:
+        shown = impact["unmatched_files"][:20]
+        more = f", +{len(impact['unmatched_files']) - len(shown)} more" if len(impact["unmatched_files"]) > len(shown) else ""
+        lines.append(f"changed files outside the UML model: {', '.join(shown)}{more}")
+    return "\n".join(lines)
+
+
+def method_impact(repo_path: str, revisions: str) -> str:
+    """format_impact of changed_methods, or an error message, for the agents' tools."""
+    if not os.path.exists(os.path.join(repo_path, ".git")):
+        return f"Error: {repo_path} is not a valid Git repository."
+    try:
+        return format_impact(changed_methods(repo_path, revisions))
+    except GitError as e:
+        return f"Error: {e}"
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    print(method_impact(sys.argv[1], sys.argv[2]))
@@ -1,9 +1,19 @@
+import os
+import re
+import json
+import time
+import threading
+from contextvars import ContextVar
 from typing import Any
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
 from typing import Annotated, Literal, List, Optional, Dict, Literal
 
 from typing_extensions import TypedDict
 from langgraph.graph.message import AnyMessage, add_messages
 
+from model import HISTORY_DB
+
 # Define the state for the agent
 class State(TypedDict):
     messages: Annotated[list[AnyMessage], add_messages]
@@ -19,4 +29,358 @@ class DBState(TypedDict):
     # user_query: Annotated[Optional[str], "User query"]
 
 class UMLState(TypedDict):
-    user_query: Annotated[list[AnyMessage], add_messages]
\ No newline at end of file
+    user_query: Annotated[list[AnyMessage], add_messages]
+
+# === Bounded SQL results for the agents' query tools ===
+# Tool output goes straight into the LLM prompt: rows are streamed from the
+# cursor into a compact table and cut off at a row and a byte budget.
+
+QUERY_MAX_ROWS = 50
+QUERY_MAX_BYTES = 8000
+QUERY_MAX_CELL = 200
+# Rows past the page are counted up to this many, then reported as "at least"
+QUERY_COUNT_AHEAD = 10000
+
+def format_cell(value, max_cell: int = QUERY_MAX_CELL) -> str:
+    text = "NULL" if value is None else str(value).replace("\n", "\\n").replace("|", "\\|")
+    return text if len(text) <= max_cell else text[:max_cell] + f"…(+{len(text) - max_cell} chars)"
+
+def page_rows(result, offset: int = 0, max_rows: int = QUERY_MAX_ROWS, max_bytes: int = QUERY_MAX_BYTES) -> str:
+    """
+    Format one page of an SQLAlchemy result, starting at row `offset`, as a
+    "col | col" table followed by a line saying how many rows were shown and
+    whether more follow (and the offset to ask for them). Rows are read one at
+    a time from the cursor, so the full result is never held in memory.
+    """
+    if not result.returns_rows:
+        return f"(statement executed, {result.rowcount} rows affected)"
+    lines = [" | ".join(result.keys())]
+    size = len(lines[0])
+    shown = more = 0
+    for index, row in enumerate(result):
+        if index < offset:
+            continue
+        if not more and shown < max_rows:
+            line = " | ".join(format_cell(value) for value in row)
+            if size + len(line) + 1 <= max_bytes or not shown:
+                lines.append(line)
+                size += len(line) + 1
+                shown += 1
+                continue
+        more += 1
+        if more >= QUERY_COUNT_AHEAD:
+            break
+    if more:
+        lines.append(
+            f"({shown} rows shown from offset {offset}; {'at least ' if more >= QUERY_COUNT_AHEAD else ''}{more} more rows, "
+            f"call again with offset={offset + shown} or narrow the query)"
+        )
+    else:
+        lines.append(f"({shown} rows)")
+    return "\n".join(lines)
+
+
+# === Shared read-only engine for agent-issued SQL ===
+# Every agent tool reads the UML database through one pool per file, opened
+# read-only so LLM-written SQL cannot modify it, and tuned for concurrent readers.
+
+AGENT_POOL_SIZE = 8
+AGENT_MMAP_BYTES = 256 * 1024 * 1024
+AGENT_CACHE_KIB = 64 * 1024
+
+agent_engines = {}
+agent_engines_lock = threading.Lock()
+
+# Set by the caller for the duration of one question; once the event is set,
+# SQL still running on that question's behalf is interrupted.
+sql_cancelled: ContextVar[Optional[threading.Event]] = ContextVar("sql_cancelled", default=None)
+
+# The progress handler runs every SQL_PROGRESS_STEPS SQLite VM steps
+SQL_PROGRESS_STEPS = 5000
+
+def sql_progress():
+    """Non-zero aborts the running statement: its question was cancelled or its budget is spent."""
+    cancelled = sql_cancelled.get()
+    if cancelled is not None and cancelled.is_set():
+        return 1
+    budget = sql_budget.get()
+    if budget is not None:
+        budget.steps_left -= SQL_PROGRESS_STEPS
+        if budget.steps_left < 0:
+            budget.exceeded = "steps"
+            return 1
+        if time.monotonic() > budget.deadline:
+            budget.exceeded = "time"
+            return 1
+    return 0
+
+def tune_agent_connection(dbapi_connection, connection_record):
+    dbapi_connection.set_progress_handler(sql_progress, SQL_PROGRESS_STEPS)
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only = ON")
+    cursor.execute(f"PRAGMA mmap_size = {AGENT_MMAP_BYTES}")
+    cursor.execute(f"PRAGMA cache_size = -{AGENT_CACHE_KIB}")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.close()
+
+def attach_history(dbapi_connection, connection_record, connection_proxy):
+    """
+    Attach the git history index (model.HISTORY_DB), read-only, once it
+    exists: its tables then resolve by their plain names next to the UML ones.
+    """
+    if connection_record.info.get("history_attached"):
+        return
+    path = os.path.abspath(HISTORY_DB)
+    if os.path.exists(path):
+        dbapi_connection.execute("ATTACH DATABASE ? AS history", (f"file:{path}?mode=ro",))
+        connection_record.info["history_attached"] = True
+
+def agent_engine(path: str = "uml-data.db"):
+    """
+    The shared engine for agent SQL on the SQLite file `path`: opened with
+    mode=ro and query_only, memory-mapped, with a large page cache per
+    connection and up to AGENT_POOL_SIZE pooled readers. Not immutable, since
+    the server and the extractor still write the file; with the file in WAL
+    mode (see model.migrate_schema) those writes do not block the readers.
+    The git history index is attached as schema "history".
+    """
+    path = os.path.abspath(path)
+    with agent_engines_lock:
+        engine = agent_engines.get(path)
+        if engine is None:
+            engine = create_engine(f"sqlite:///file:{path}?mode=ro&uri=true", pool_size=AGENT_POOL_SIZE, max_overflow=0)
+            event.listen(engine, "connect", tune_agent_connection)
+            event.listen(engine, "checkout", attach_history)
+            agent_engines[path] = engine
+    return engine
+
+
+# === Guard for LLM-written SQL ===
+# Agent SQL runs under a wall-clock and VM-step budget, enforced by the
+# progress handler above, after its EXPLAIN QUERY PLAN has been vetted.
+
+SQL_TIMEOUT_SECONDS = 10.0
+SQL_MAX_STEPS = 200_000_000
+# Tables that grow with the codebase or its history; nested full scans over them are cross joins
+GUARDED_TABLES = {"uml_class", "uml_property", "uml_method", "uml_parameter", "uml_relationship", "git_commit", "git_file_change"}
+# Tables carrying large text (method sources), and how many rows they may have to still be scanned whole
+LARGE_TEXT_TABLES = {"uml_method"}
+FULL_SCAN_MAX_ROWS = 200_000
+
+class SQLRejected(Exception):
+    """Agent SQL refused or stopped by the guard; str() is a JSON object the agent can act on."""
+
+    def __init__(self, reason: str, hint: str, **details):
+        self.reason = reason
+        self.details = {"error": reason, **details, "hint": hint}
+        super().__init__(json.dumps(self.details))
+
+class SQLBudget:
+    def __init__(self, seconds: float, steps: int):
+        self.seconds = seconds
+        self.steps = steps
+        self.deadline = time.monotonic() + seconds
+        self.steps_left = steps
+        self.exceeded = None
+
+sql_budget: ContextVar[Optional[SQLBudget]] = ContextVar("sql_budget", default=None)
+
+def scanned_table(sql: str, name: str) -> str:
+    """The table behind `name` in a query plan line, which SQLite reports by alias when there is one."""
+    if name in GUARDED_TABLES:
+        return name
+    match = re.search(rf"\b({'|'.join(GUARDED_TABLES)})\s+(?:AS\s+)?{re.escape(name)}\b", sql, re.IGNORECASE)
+    return match.group(1).lower() if match else name
+
+def table_rows(conn, table: str) -> Optional[int]:
+    """Row count of `table` from the ANALYZE statistics, if there are any."""
+    try:
+        stats = conn.exec_driver_sql("SELECT stat FROM sqlite_stat1 WHERE tbl = ?", (table,)).scalars().all()
+    except Exception:
+        return None
+    return max((int(stat.split()[0]) for stat in stats), default=None)
+
+def check_query_plan(conn, sql: str):
+    """
+    Reject `sql` before it runs if its plan nests full scans over a table that
+    grows with the codebase (a join without a usable join condition), or
+    scans a large-text table whole while it is bigger than FULL_SCAN_MAX_ROWS.
+    """
+    scans = {}
+    for _, parent, _, detail in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}"):
+        # Older SQLite says "SCAN TABLE x"
+        match = re.match(r"SCAN (?:TABLE )?(\w+)( USING (?:COVERING )?INDEX)?", detail)
+        if not match or match.group(1) == "CONSTANT":
+            continue
+        table = scanned_table(sql, match.group(1))
+        scans.setdefault(parent, []).append(table)
+        if table in LARGE_TEXT_TABLES and not match.group(2):
+            rows = table_rows(conn, table)
+            if rows is not None and rows > FULL_SCAN_MAX_ROWS:
+                raise SQLRejected(
+                    "full_scan", f"Filter {table} through an indexed column (id, class_id, name) instead of scanning all of it.",
+                    table=table, rows=rows
+                )
+    for tables in scans.values():
+        if len(tables) > 1 and GUARDED_TABLES.intersection(tables):
+            raise SQLRejected(
+                "cross_join", "Join these tables on their key columns (e.g. uml_parameter.method_id = uml_method.id, "
+                "uml_method.class_id = uml_class.id, git_file_change.sha = git_commit.sha) or filter them before joining.",
+                tables=tables
+            )
+
+def guarded_page(conn, sql: str, offset: int = 0) -> str:
+    """page_rows for agent SQL: plan vetted first, then executed and read within the SQL budget."""
+    check_query_plan(conn, sql)
+    budget = SQLBudget(SQL_TIMEOUT_SECONDS, SQL_MAX_STEPS)
+    token = sql_budget.set(budget)
+    try:
+        return page_rows(conn.execute(text(sql)), offset)
+    except OperationalError:
+        if budget.exceeded == "time":
+            raise SQLRejected("timeout", "Narrow the query (WHERE on indexed columns, LIMIT) so it finishes in time.",
+                              seconds=budget.seconds)
+        if budget.exceeded == "steps":
+            raise SQLRejected("step_limit", "Narrow the query (WHERE on indexed columns, LIMIT); it does too much work.",
+                              steps=budget.steps)
+        raise
+    finally:
+        sql_budget.reset(token)
+
+
+# === Compact diagram context for the agents' prompts ===
+# The front end sends the whole diagram JSON with a question. It is reduced
+# once per question to a digest, and each prompt only gets a line per class
+# relevant to its own query instead of the full JSON.
+
+DIAGRAM_MAX_ELEMENTS = 20
+DIAGRAM_MAX_MEMBERS = 12
+DIAGRAM_MAX_EDGES = 40
+# Diagram text that is not JSON is passed on, cut to this many characters
+DIAGRAM_MAX_CHARS = 4000
+DIAGRAM_STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "what", "which", "who", "how", "why", "are", "was", "were",
+    "does", "did", "has", "have", "from", "into", "than", "less", "more", "all", "any", "out", "show", "list",
+    "find", "get", "set", "class", "classes", "method", "methods", "package", "packages",
+}
+
+def diagram_terms(text: str) -> set:
+    """Lower-cased words of `text`, with identifiers split at camelCase humps, dots and underscores."""
+    words = re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+", text or "")
+    return {word.lower() for word in words if len(word) > 2} - DIAGRAM_STOPWORDS
+
+def diagram_digest(diagram: Optional[str]) -> Optional[dict]:
+    """
+    Reduce a class or package diagram's JSON to its elements (id, kind, files
+    and member names of every class and package) and its edges
+    ([source, type, target] of every relationship).
+    """
+    if not diagram:
+        return None
+    try:
+        data = json.loads(diagram)
+    except ValueError:
+        return {"text": diagram[:DIAGRAM_MAX_CHARS], "elements": [], "edges": []}
+    elements, edges = [], []
+
+    def name_of(member):
+        return member if isinstance(member, str) else str(member.get("name", ""))
+
+    def visit(node, key=None):
+        if isinstance(node, list):
+            for item in node:
+                visit(item, key)
+            return
+        if not isinstance(node, dict):
+            return
+        if "source" in node and "target" in node:
+            edges.append([str(node["source"]), str(node.get("type") or node.get("name") or ""), str(node["target"])])
+            return
+        if key in ("classes", "packages", "subpackages") and ("id" in node or "name" in node):
+            name = str(node.get("name", ""))
+            kind = node.get("type") or ("package" if key != "classes" else "class")
+            if node.get("isInterface"):
+                kind = "interface"
+            elif node.get("isAbstract"):
+                kind = f"abstract {kind}"
+            elements.append({
+                "id": str(node.get("id") or (f"{node['package']}.{name}" if node.get("package") else name)),
+                "kind": kind,
+                "files": [str(f) for f in node.get("files") or []],
+                # Package diagrams list classes without their members
+                "has_members": "properties" in node or "methods" in node,
+                "properties": [name_of(p) for p in node.get("properties") or []],
+                "methods": [name_of(m) for m in node.get("methods") or []],
+            })
+        for child_key, value in node.items():
+            if isinstance(value, (list, dict)):
+                visit(value, child_key)
+
+    visit(data)
+    return {"elements": elements, "edges": edges}
+
+def diagram_context(digest: Optional[dict], query: str, members: bool = True, files: bool = False,
+                    max_elements: int = DIAGRAM_MAX_ELEMENTS) -> str:
+    """
+    The part of a diagram digest relevant to `query`, one line per element:
+    elements whose name or members share words with the query and their
+    direct neighbours, or the most connected ones if none match, followed by
+    the relationships touching them. `members` lists member names, `files`
+    the source files (for the git history).
+    """
+    if not digest:
+        return ""
+    if digest.get("text"):
+        return digest["text"]
+    elements, edges = digest["elements"], digest["edges"]
+    terms = diagram_terms(query)
+    degree = {}
+    for source, _, target in edges:
+        degree[source] = degree.get(source, 0) + 1
+        degree[target] = degree.get(target, 0) + 1
+
+    def score(element):
+        return (3 * len(terms & diagram_terms(element["id"]))
+                + len(terms & diagram_terms(" ".join(element["properties"] + element["methods"]))))
+
+    scores = {element["id"]: score(element) for element in elements}
+    ranked = sorted(elements, key=lambda e: (-scores[e["id"]], -degree.get(e["id"], 0)))
+    matched = [e["id"] for e in ranked if scores[e["id"]] > 0][:max_elements]
+    chosen = set(matched)
+    if matched:
+        for source, _, target in edges:
+            if len(chosen) >= max_elements:
+                break
+            if source in matched or target in matched:
+                chosen.update((source, target))
+    else:
+        chosen = {e["id"] for e in ranked[:max_elements]}
+    shown = [e for e in ranked if e["id"] in chosen]
+
+    if len(shown) == len(elements):
+        which = "all shown"
+    elif matched:
+        which = f"{len(shown)} shown: those matching the query and their neighbours"
+    else:
+        which = f"{len(shown)} shown: none match the query, these are the most connected"
+    lines = [f"{len(elements)} elements, {len(edges)} relationships; {which}"]
+    for element in shown:
+        line = f"- {element['id']} [{element['kind']}]"
+        if element["has_members"]:
+            line += f" {len(element['properties'])} properties, {len(element['methods'])} methods"
+        if members:
+            for label in ("properties", "methods"):
+                names = element[label]
+                if names:
+                    more = f", +{len(names) - DIAGRAM_MAX_MEMBERS} more" if len(names) > DIAGRAM_MAX_MEMBERS else ""
+                    line += f"; {label}: {', '.join(names[:DIAGRAM_MAX_MEMBERS])}{more}"
+        if files and element["files"]:
+            line += f"; files: {', '.join(element['files'])}"
+        lines.append(line)
+    touching = [edge for edge in edges if edge[0] in chosen or edge[2] in chosen]
+    if touching:
+        lines.append("relationships:")
+        lines.extend(f"- {source} -{kind}-> {target}" for source, kind, target in touching[:DIAGRAM_MAX_EDGES])
+        if len(touching) > DIAGRAM_MAX_EDGES:
+            lines.append(f"- +{len(touching) - DIAGRAM_MAX_EDGES} more")
+    return "\n".join(lines)
@@ -1,15 +1,11 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from graph import db_app
+from graph import ask
 
 
-messages = db_app.invoke(
-    {
-        "messages": [("user", "Is the class org.keycloak.transaction.JtaTransactionWrapper abstract ?")]
-    }
-)
-json_str = messages["messages"][-1].tool_calls[0]["args"]["final_answer"]
+# Answered by db_app the first time, from the answer cache afterwards
+json_str = ask("Is the class org.keycloak.transaction.JtaTransactionWrapper abstract ?")
 print(json_str)
 # print(messages)
 # messages: Annotated[list[AnyMessage], add_messages]
@@ -0,0 +1,279 @@
+"""
+Long-lived git processes for the history agent.
+
+`git cat-file --batch` answers any number of object requests over its stdin,
+so instead of spawning `git show` (and reopening the repository) for every
+read, each repository keeps a few of them open and hands every request to
+whichever one is free. --batch-check workers answer type and size probes
+without reading the object.
+
+Output of git commands that only read history is cached per repository,
+refs and command, so it is recomputed only after a ref moves.
+"""
+import os
+import hashlib
+import queue
+import subprocess
+import threading
+
+from cache import GitCommandCache
+
+CAT_FILE_WORKERS = 2
+# Object pages handed to the agent: lines per page, bytes per page and per line
+OBJECT_MAX_LINES = 200
+OBJECT_MAX_BYTES = 8000
+OBJECT_MAX_LINE = 400
+# A blob with a NUL byte in its first BINARY_PROBE_BYTES is not shown
+BINARY_PROBE_BYTES = 8000
+# Subcommands whose output depends only on objects and refs: not on the
+# working tree or the index, and without side effects (not describe: --dirty)
+CACHEABLE_GIT_COMMANDS = {
+    "log", "show", "shortlog", "rev-list", "ls-tree", "cat-file", "name-rev", "merge-base", "for-each-ref",
+}
+
+# Arguments whose output changes with the clock or with reflogs, which refs_stamp
+# does not see: date limits, relative dates, and reflog walks (-g, @{...})
+TIME_DEPENDENT_GIT_ARGS = (
+    "--since", "--until", "--after", "--before", "--max-age", "--min-age",
+    "--date=relative", "--date=human", "--relative-date", "--walk-reflogs",
+)
+# --format placeholders for relative, human or --date-dependent dates
+RELATIVE_DATE_PLACEHOLDERS = ("%ar", "%cr", "%ah", "%ch", "%ad", "%cd")
+
+# The cache file is only created once a cacheable command runs
+git_command_cache = GitCommandCache(
+    os.getenv("GIT_CACHE_DB", "git-cache.db"),
+    max_bytes=int(os.getenv("GIT_CACHE_BYTES", str(64 * 2**20))),
+)
+
+
+class GitError(Exception):
+    pass
+
+
+def git(repo_path: str, *args) -> str:
+    result = subprocess.run(["git", *args], cwd=repo_path, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise GitError(f"git {' '.join(args)}: {result.stderr.strip()}")
+    return result.stdout.strip()
+
+
+class CatFile:
+    """One `git cat-file --batch` (or --batch-check) process, started on first use; one request at a time."""
+
+    def __init__(self, repo: str, check: bool = False):
+        self.repo = repo
+        self.check = check
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch-check" if self.check else "--batch"],
+            cwd=self.repo, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+
+    def close(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def request(self, spec: str):
+        """{"oid", "type", "size", "content"} of the object `spec` names (content None for --batch-check), or None."""
+        if "\n" in spec:
+            raise ValueError("object names cannot contain newlines")
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        try:
+            self.process.stdin.write(spec.encode() + b"\n")
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            if not header:
+                raise GitError(f"git cat-file exited in {self.repo}")
+            fields = header.decode().split()
+            if fields[-1] in ("missing", "ambiguous"):
+                return None
+            content = None
+            if not self.check:
+                content = self.process.stdout.read(int(fields[2]) + 1)[:-1]
+            return {"oid": fields[0], "type": fields[1], "size": int(fields[2]), "content": content}
+        except (OSError, ValueError, IndexError) as e:
+            # The stream is out of step with the requests; start over on the next one
+            self.close()
+            raise GitError(f"git cat-file failed in {self.repo}: {e}")
+        except GitError:
+            self.close()
+            raise
+
+
+class CatFilePool:
+    """Up to `size` --batch and `size` --batch-check processes for one repository."""
+
+    def __init__(self, repo: str, size: int = CAT_FILE_WORKERS):
+        self.repo = repo
+        self.workers = {check: queue.LifoQueue() for check in (False, True)}
+        for check, workers in self.workers.items():
+            for _ in range(size):
+                workers.put(CatFile(repo, check))
+
+    def request(self, spec: str, check: bool = False):
+        workers = self.workers[check]
+        worker = workers.get()
+        try:
+            return worker.request(spec)
+        finally:
+            workers.put(worker)
+
+    def read(self, spec: str):
+        return self.request(spec)
+
+    def info(self, spec: str):
+        return self.request(spec, check=True)
+
+    def close(self):
+        for workers in self.workers.values():
+            for worker in list(workers.queue):
+                worker.close()
+
+
+git_pools = {}
+git_pools_lock = threading.Lock()
+
+def git_pool(repo_path: str) -> CatFilePool:
+    """The shared cat-file pool of the repository at `repo_path`."""
+    repo = os.path.realpath(repo_path)
+    with git_pools_lock:
+        pool = git_pools.get(repo)
+        if pool is None:
+            pool = git_pools[repo] = CatFilePool(repo)
+    return pool
+
+
+def tree_entries(content: bytes, oid_bytes: int):
+    """(mode, oid, name) of each entry of a raw tree object."""
+    entries, position = [], 0
+    while position < len(content):
+        end = content.index(b"\0", position)
+        mode, _, name = content[position:end].partition(b" ")
+        oid = content[end + 1:end + 1 + oid_bytes].hex()
+        entries.append((mode.decode(), oid, name.decode("utf-8", "replace")))
+        position = end + 1 + oid_bytes
+    return entries
+
+
+def format_object(obj: dict, offset: int = 0, max_lines: int = OBJECT_MAX_LINES, max_bytes: int = OBJECT_MAX_BYTES) -> str:
+    """
+    One page of a git object for the agent: a header line, then the lines of
+    a commit, tag or text blob (a tree as "mode oid name" lines) from line
+    `offset`, cut at `max_lines` and `max_bytes`, and a line saying which
+    lines were shown and the offset to ask for the next ones.
+    """
+    header = f"{obj['type']} {obj['oid']} ({obj['size']} bytes)"
+    content = obj["content"]
+    if obj["type"] == "tree":
+        lines = [f"{mode} {oid} {name}" for mode, oid, name in tree_entries(content, len(obj["oid"]) // 2)]
+    elif obj["type"] == "blob" and b"\0" in content[:BINARY_PROBE_BYTES]:
+        return f"{header}\n(binary content not shown)"
+    else:
+        lines = content.decode("utf-8", "replace").splitlines()
+
+    page, size = [], len(header)
+    for line in lines[offset:offset + max_lines]:
+        if len(line) > OBJECT_MAX_LINE:
+            line = line[:OBJECT_MAX_LINE] + f"…(+{len(line) - OBJECT_MAX_LINE} chars)"
+        if page and size + len(line) + 1 > max_bytes:
+            break
+        page.append(line)
+        size += len(line) + 1
+    shown_to = offset + len(page)
+    if shown_to < len(lines):
+        footer = f"(lines {offset + 1}-{shown_to} of {len(lines)} shown, call again with offset={shown_to} for more)"
+    else:
+        footer = f"({len(lines)} lines)" if not offset else f"(lines {offset + 1}-{shown_to} of {len(lines)} shown)"
+    return "\n".join([header, *page, footer])
+
+
+def read_object_page(repo_path: str, revision: str, path: str = "", offset: int = 0) -> str:
+    """format_object of `revision` (or of `path` at `revision`) read through the repository's cat-file pool."""
+    if not os.path.exists(os.path.join(repo_path, ".git")):
+        return f"Error: {repo_path} is not a valid Git repository."
+    spec = f"{revision}:{path}" if path else revision
+    try:
+        obj = git_pool(repo_path).read(spec)
+    except (GitError, ValueError) as e:
+        return f"Error reading {spec}: {e}"
+    if obj is None:
+        return f"Error: {spec} does not name an object in {repo_path}."
+    return format_object(obj, max(offset, 0))
+
+
+git_dirs = {}
+
+def git_common_dir(repo: str) -> str:
+    """The directory holding `repo`'s refs (.git, or the main repository's for a worktree)."""
+    path = git_dirs.get(repo)
+    if path is None:
+        path = os.path.join(repo, ".git")
+        if not os.path.isdir(path):
+            path = os.path.join(repo, git(repo, "rev-parse", "--git-common-dir"))
+        path = git_dirs[repo] = os.path.realpath(path)
+    return path
+
+
+def refs_stamp(repo: str) -> str:
+    """
+    Changes whenever a ref moves: the commit HEAD resolves to (through the
+    cat-file pool, without spawning git) plus mtime and size of packed-refs
+    and of every loose ref.
+    """
+    head = git_pool(repo).info("HEAD")
+    parts = [head["oid"] if head else "-"]
+    root = git_common_dir(repo)
+    ref_files = [os.path.join(root, "packed-refs")]
+    for directory, _, files in os.walk(os.path.join(root, "refs")):
+        ref_files.extend(os.path.join(directory, name) for name in files)
+    for path in sorted(ref_files):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        parts.append(f"{os.path.relpath(path, root)}:{stat.st_mtime_ns:x}:{stat.st_size:x}")
+    return hashlib.blake2b("|".join(parts).encode(), digest_size=16).hexdigest()
+
+
+def is_cacheable(args: list) -> bool:
+    # ":path" names the index, --output writes a file; the rest depend on the clock or the reflogs
+    return bool(args) and args[0] in CACHEABLE_GIT_COMMANDS and not any(
+        arg.startswith((":", "--output") + TIME_DEPENDENT_GIT_ARGS) or arg in ("-g", "--reflog") or "@{" in arg
+        or any(placeholder in arg for placeholder in RELATIVE_DATE_PLACEHOLDERS)
+        for arg in args
+    )
+
+
+def git_command_output(repo_path: str, command: str) -> str:
+    """
+    Output of `git <command>` in `repo_path`, or an error message, for the
+    agents' run_git_command tool. Commands that only read history are served
+    from git_command_cache until a ref moves; failures are not cached.
+    """
+    if not os.path.exists(os.path.join(repo_path, ".git")):
+        return f"Error: {repo_path} is not a valid Git repository."
+    args = command.strip().split()
+    key = None
+    if is_cacheable(args):
+        repo = os.path.realpath(repo_path)
+        try:
+            key = GitCommandCache.key(repo, refs_stamp(repo), command)
+        except GitError:
+            key = None
+        if key is not None:
+            output = git_command_cache.get(key)
+            if output is not None:
+                return output
+    try:
+        result = subprocess.run(["git"] + args, cwd=repo_path, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        return f"Error running git command: {e.stderr}"
+    if key is not None:
+        git_command_cache.put(key, repo, command, result.stdout)
+    return result.stdout
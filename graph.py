@@ -1,10 +1,17 @@
-from typing import Literal, Any
+import os
+import re
+import logging
+import uuid
+import sqlite3
+import threading
+from typing import Literal, Any, Optional
 from pydantic import BaseModel, Field
 
 from langchain_ollama import ChatOllama
 from langchain_groq import ChatGroq
 from langchain_community.utilities import SQLDatabase
-from langchain_community.agent_toolkits import SQLDatabaseToolkit
+from sqlalchemy import inspect
+from sqlalchemy.exc import SQLAlchemyError
 
 from langchain_core.tools import tool
 from langchain_core.prompts import ChatPromptTemplate
@@ -13,11 +20,15 @@ from langchain_core.runnables import RunnableLambda, RunnableWithFallbacks
 from langgraph.prebuilt import ToolNode
 from langgraph.graph import END, StateGraph, START
 
-from common import DBState
+from common import DBState, agent_engine, guarded_page, sql_cancelled
+from model import db_version, HISTORY_DB
+from history_index import remap_classes
+from cache import AnswerCache
 from dotenv import load_dotenv
 load_dotenv()
 
-db = SQLDatabase.from_uri("sqlite:///uml-data.db")
+DB_PATH = "uml-data.db"
+db_engine = agent_engine(DB_PATH)
 # model="llama-3.3-70b-versatile"
 #deepseek-r1-distill-llama-70b
 def getLLM():
@@ -50,22 +61,20 @@ def handle_tool_error(state: DBState) -> dict:
     }
 
 
-toolkit = SQLDatabaseToolkit(db=db, llm=getLLM())
-tools = toolkit.get_tools()
-
-list_tables_tool = next(tool for tool in tools if tool.name == "sql_db_list_tables")
-get_schema_tool = next(tool for tool in tools if tool.name == "sql_db_schema")
-
-
 @tool
-def db_query_tool(query: str) -> str:
+def db_query_tool(query: str, offset: int = 0) -> str:
     """
     Execute a SQL query against the database and get back the result.
     If the query is not correct, an error message will be returned.
     If an error is returned, rewrite the query, check the query, and try again.
+    Long results come back one page at a time; pass `offset` to read further.
     """
-    result = db.run_no_throw(query)
-    if not result:
+    try:
+        with db_engine.connect() as conn:
+            result = guarded_page(conn, query, offset)
+    except Exception as e:
+        return f"Error: {e}"
+    if result.endswith("\n(0 rows)") and not offset:
         return "Error: Query failed. Please rewrite your query and try again."
     return result
 
@@ -85,6 +94,97 @@ query_check = query_check_prompt | getLLM().bind_tools(
 )
 
 
+# Derived tables (server caches, the git history index), not part of the extracted model
+INTERNAL_TABLES = {
+    "uml_rollup_state", "uml_snapshot", "uml_class_file",
+    "git_commit", "git_file_change", "git_file_churn", "git_index_state",
+}
+# Tables of the attached git history index (see common.attach_history) the SQL agent may read
+HISTORY_TABLES = ["uml_class_churn"]
+schema_cache = {}
+schema_lock = threading.Lock()
+
+def data_version() -> str:
+    """Version stamp of everything the SQL agent reads: the UML database and the git history index."""
+    return f"{db_version(DB_PATH)}+{db_version(HISTORY_DB)}"
+
+def schema_context():
+    """
+    The table list, the DDL with sample rows and the SQLDatabase of the UML
+    tables and of the history tables (None until the history is indexed),
+    as the list-tables and schema tools return them. Rebuilt when either
+    database file changes, since that is when tables can appear.
+    """
+    with schema_lock:
+        cached = schema_cache.get((DB_PATH, data_version()))
+        if cached is not None:
+            return cached
+        # uml_class_churn is keyed by uml_class.id: re-map it onto the classes of a re-ingested
+        # database before the agent sees it, and leave it out when that is not possible
+        try:
+            history_current = remap_classes()
+        except SQLAlchemyError as e:
+            logging.warning("Could not map the git history onto the current UML data: %s", e)
+            history_current = False
+        db = SQLDatabase(db_engine)
+        tables = [table for table in db.get_usable_table_names() if table not in INTERNAL_TABLES]
+        table_info = db.get_table_info_no_throw(tables)
+        history_db = None
+        with db_engine.connect() as conn:
+            attached = conn.exec_driver_sql(
+                "SELECT 1 FROM pragma_database_list WHERE name = 'history'"
+            ).scalar() is not None
+            present = set(inspect(conn).get_table_names(schema="history")) if attached else set()
+        # SQLDatabase raises for include_tables it cannot find
+        history_tables = [table for table in HISTORY_TABLES if table in present]
+        if history_current and history_tables:
+            history_db = SQLDatabase(db_engine, schema="history", include_tables=history_tables)
+            tables = tables + history_tables
+            table_info = f"{table_info}\n\n{history_db.get_table_info_no_throw(history_tables)}"
+        cached = (tables, table_info, db, history_db)
+        schema_cache.clear()
+        schema_cache[(DB_PATH, data_version())] = cached
+    return cached
+
+
+@tool("sql_db_list_tables")
+def list_tables_tool(tool_input: str = "") -> str:
+    """Input is an empty string, output is a comma-separated list of tables in the database."""
+    return ", ".join(schema_context()[0])
+
+@tool("sql_db_schema")
+def get_schema_tool(table_names: str) -> str:
+    """
+    Get the schema and sample rows for the specified SQL tables.
+    Input is a comma-separated list of tables, e.g. "uml_class, uml_method".
+    """
+    _, _, db, history_db = schema_context()
+    names = [name.strip() for name in table_names.split(",") if name.strip()]
+    history_names = [name for name in names if history_db is not None and name in HISTORY_TABLES]
+    parts = [db.get_table_info_no_throw([name for name in names if name not in history_names])]
+    if history_names:
+        parts.append(history_db.get_table_info_no_throw(history_names))
+    return "\n\n".join(parts)
+
+
+def cached_schema_call(state: DBState) -> dict[str, list]:
+    """
+    Replay the discovery steps (list tables, pick tables, fetch their schema)
+    from the schema cache, with the same tool calls and results the LLM would
+    otherwise see, but no LLM round trip and no tool hops.
+    """
+    tables, table_info, _, _ = schema_context()
+    table_names = ", ".join(tables)
+    return {
+        "messages": [
+            AIMessage(content="", tool_calls=[{"name": "sql_db_list_tables", "args": {}, "id": "tool_abcd123"}]),
+            ToolMessage(content=table_names, name="sql_db_list_tables", tool_call_id="tool_abcd123"),
+            AIMessage(content="", tool_calls=[{"name": "sql_db_schema", "args": {"table_names": table_names}, "id": "tool_abcd124"}]),
+            ToolMessage(content=table_info, name="sql_db_schema", tool_call_id="tool_abcd124"),
+        ]
+    }
+
+
 # Add a node for the first tool call
 def first_tool_call(state: DBState) -> dict[str, list[AIMessage]]:
     return {
@@ -103,17 +203,81 @@ def first_tool_call(state: DBState) -> dict[str, list[AIMessage]]:
     }
 
 
+# Authorizer actions a query may need; anything else means it is not a plain read
+READ_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+def extract_sql(content: str) -> str:
+    """The SQL in a query_gen message: the fenced block if there is one, else the whole text."""
+    fenced = re.search(r"```(?:sql)?\s*(.*?)```", content, re.DOTALL | re.IGNORECASE)
+    return (fenced.group(1) if fenced else content).strip().rstrip(";").strip()
+
+def validate_sql(sql: str) -> Optional[str]:
+    """
+    Check `sql` without an LLM: SQLite parses it and resolves every table and
+    column against the real schema while preparing EXPLAIN, and the authorizer
+    rejects anything but reads of the extracted uml_* tables. Returns the
+    problem, or None if the query can be run as is.
+    """
+    if not sql:
+        return "empty query"
+    problems = []
+
+    def authorize(action, table, column, database, trigger):
+        if action not in READ_ACTIONS:
+            problems.append("only read-only SELECT queries are allowed")
+            return sqlite3.SQLITE_DENY
+        if action == sqlite3.SQLITE_READ and table in INTERNAL_TABLES:
+            problems.append(f"{table} is not part of the UML schema")
+            return sqlite3.SQLITE_DENY
+        return sqlite3.SQLITE_OK
+
+    with db_engine.connect() as conn:
+        dbapi_connection = conn.connection.dbapi_connection
+        dbapi_connection.set_authorizer(authorize)
+        try:
+            conn.exec_driver_sql(f"EXPLAIN {sql}")
+        except Exception as e:
+            return problems[0] if problems else str(getattr(e, "orig", None) or e)
+        finally:
+            dbapi_connection.set_authorizer(None)
+    return None
+
+def validate_query(state: DBState) -> dict[str, list[AIMessage]]:
+    """
+    Local stand-in for the LLM checker: a generated query that validates is
+    sent straight to execute_query, as the db_query_tool call correct_query
+    would have made. Anything else is left for correct_query to fix.
+    """
+    sql = extract_sql(state["messages"][-1].content)
+    if validate_sql(sql) is not None:
+        return {"messages": []}
+    tool_call = {"name": "db_query_tool", "args": {"query": sql}, "id": f"validated_{uuid.uuid4().hex[:12]}"}
+    return {"messages": [AIMessage(content="", tool_calls=[tool_call])]}
+
+def after_validation(state: DBState) -> Literal["execute_query", "correct_query"]:
+    return "execute_query" if getattr(state["messages"][-1], "tool_calls", None) else "correct_query"
+
+
 def model_check_query(state: DBState) -> dict[str, list[AIMessage]]:
     """
     Use this tool to double-check if your query is correct before executing it.
     """
     return {"messages": [query_check.invoke({"messages": [state["messages"][-1]]})]}
 
+async def amodel_check_query(state: DBState) -> dict[str, list[AIMessage]]:
+    return {"messages": [await query_check.ainvoke({"messages": [state["messages"][-1]]})]}
+
 # Add a node for a model to choose the relevant tables based on the question and available tables
 model_get_schema = getLLM().bind_tools(
     [get_schema_tool]
 )
 
+def model_get_schema_node(state: DBState):
+    return {"messages": [model_get_schema.invoke(state["messages"])]}
+
+async def amodel_get_schema_node(state: DBState):
+    return {"messages": [await model_get_schema.ainvoke(state["messages"])]}
+
 # Describe a tool to represent the end state
 class SubmitFinalAnswer(BaseModel):
     """Submit the final answer to the user based on the query results."""
@@ -129,7 +293,7 @@ The database schema includes tables such as `uml_class`, `uml_property`, `uml_me
 - `uml_property` stores the fields or attributes of each class.
 - `uml_method` stores the methods/functions and their visibility.
 - `uml_relationship` describes associations like inheritance, composition, and method-level dependencies between classes.
-
+{history_tables}
 You are helping users query this repository to answer questions like:
 - Which classes were edited recently?
 - Which classes have the most methods or properties?
@@ -152,10 +316,24 @@ query_gen = query_gen_prompt | getLLM().bind_tools(
     [SubmitFinalAnswer]
 )
 
+# Described to query_gen only once the history index has the table
+HISTORY_TABLES_PROMPT = {
+    "uml_class_churn": "- `uml_class_churn` holds each class's git history (join on class_id = uml_class.id): "
+                       "last_committed_at (unix seconds, use datetime(last_committed_at, 'unixepoch')), commits, authors "
+                       "and lines added, deleted and churned. Classes whose files have no history have no row.\n",
+}
+
+def query_gen_input(state: DBState) -> dict:
+    tables = schema_context()[0]
+    return {**state, "history_tables": "".join(text for table, text in HISTORY_TABLES_PROMPT.items() if table in tables)}
 
 def query_gen_node(state: DBState):
-    message = query_gen.invoke(state)
+    return check_query_gen_message(query_gen.invoke(query_gen_input(state)))
+
+async def aquery_gen_node(state: DBState):
+    return check_query_gen_message(await query_gen.ainvoke(query_gen_input(state)))
 
+def check_query_gen_message(message):
     # Sometimes, the LLM will hallucinate and call the wrong tool. We need to catch this and return an error message.
     tool_messages = []
     if message.tool_calls:
@@ -172,7 +350,7 @@ def query_gen_node(state: DBState):
     return {"messages": [message] + tool_messages}
 
 # Define a conditional edge to decide whether to continue or end the workflow
-def should_continue(state: DBState) -> Literal[END, "correct_query", "query_gen"]:
+def should_continue(state: DBState) -> Literal[END, "validate_query", "query_gen"]:
     messages = state["messages"]
     last_message = messages[-1]
     # If there is a tool call, then we finish
@@ -181,39 +359,53 @@ def should_continue(state: DBState) -> Literal[END, "correct_query", "query_gen"
     if last_message.content.startswith("Error:"):
         return "query_gen"
     else:
-        return "correct_query"
+        return "validate_query"
 
 
-def create_db_subgraph(workflow: StateGraph)-> StateGraph:
-    
-    workflow.add_node("first_tool_call", first_tool_call)
-
-    # Add nodes for the first two tools
-    workflow.add_node("list_tables_tool", create_tool_node_with_fallback([list_tables_tool]))
-    workflow.add_node("get_schema_tool", create_tool_node_with_fallback([get_schema_tool]))
+def create_db_subgraph(workflow: StateGraph, cached_schema: bool = False)-> StateGraph:
+    """
+    Add the SQL agent to `workflow`. With `cached_schema` the table list and
+    schema come from the schema cache in a single step instead of the
+    list-tables, model-picks-tables, get-schema round trips.
 
+    The LLM nodes have async twins: under astream a cancelled question aborts
+    the in-flight LLM request instead of waiting for it on a worker thread.
+    """
+    if cached_schema:
+        workflow.add_node("cached_schema", cached_schema_call)
+    else:
+        workflow.add_node("first_tool_call", first_tool_call)
 
-    workflow.add_node("model_get_schema", lambda state: { "messages": [model_get_schema.invoke(state["messages"])], },)
+        # Add nodes for the first two tools
+        workflow.add_node("list_tables_tool", create_tool_node_with_fallback([list_tables_tool]))
+        workflow.add_node("get_schema_tool", create_tool_node_with_fallback([get_schema_tool]))
+        workflow.add_node("model_get_schema", RunnableLambda(model_get_schema_node, afunc=amodel_get_schema_node))
 
-    workflow.add_node("query_gen", query_gen_node)
+    workflow.add_node("query_gen", RunnableLambda(query_gen_node, afunc=aquery_gen_node))
 
-    # Add a node for the model to check the query before executing it
-    workflow.add_node("correct_query", model_check_query)
+    # Generated queries are validated locally; the model only checks those that fail
+    workflow.add_node("validate_query", validate_query)
+    workflow.add_node("correct_query", RunnableLambda(model_check_query, afunc=amodel_check_query))
 
     # Add node for executing the query
     workflow.add_node("execute_query", create_tool_node_with_fallback([db_query_tool]))
 
 
     # Specify the edges between the nodes
-    workflow.add_edge(START, "first_tool_call")
-    workflow.add_edge("first_tool_call", "list_tables_tool")
-    workflow.add_edge("list_tables_tool", "model_get_schema")
-    workflow.add_edge("model_get_schema", "get_schema_tool")
-    workflow.add_edge("get_schema_tool", "query_gen")
+    if cached_schema:
+        workflow.add_edge(START, "cached_schema")
+        workflow.add_edge("cached_schema", "query_gen")
+    else:
+        workflow.add_edge(START, "first_tool_call")
+        workflow.add_edge("first_tool_call", "list_tables_tool")
+        workflow.add_edge("list_tables_tool", "model_get_schema")
+        workflow.add_edge("model_get_schema", "get_schema_tool")
+        workflow.add_edge("get_schema_tool", "query_gen")
     workflow.add_conditional_edges(
         "query_gen",
         should_continue,
     )
+    workflow.add_conditional_edges("validate_query", after_validation)
     workflow.add_edge("correct_query", "execute_query")
     workflow.add_edge("execute_query", "query_gen")
     
@@ -226,3 +418,60 @@ workflow = create_db_subgraph(workflow)
 
 # Compile the workflow into a runnable
 db_app = workflow.compile()
+
+# Same agent, starting from the cached schema
+db_fast_app = create_db_subgraph(StateGraph(DBState), cached_schema=True).compile()
+
+
+# === Answer cache ===
+# Repeated questions are answered from here instead of rerunning the LLM pipeline
+
+answer_cache = AnswerCache(
+    os.getenv("ANSWER_CACHE_DB", "answer-cache.db"),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600))),
+    max_entries=int(os.getenv("ANSWER_CACHE_ENTRIES", "10000")),
+)
+
+def question_prompt(question: str, context: str = "") -> str:
+    return f"User Query: {question} \n \n in the context of \n\n {context}"
+
+def final_answer(message) -> Optional[str]:
+    """The SubmitFinalAnswer payload of `message`, if it carries one."""
+    for tc in getattr(message, "tool_calls", None) or []:
+        if tc["name"] == "SubmitFinalAnswer":
+            return tc["args"].get("final_answer")
+    return None
+
+def executed_sql(messages) -> tuple[Optional[str], Optional[str]]:
+    """The last SQL the agent ran through db_query_tool, and what it returned."""
+    sql = result = None
+    calls = {}
+    for message in messages:
+        for tc in getattr(message, "tool_calls", None) or []:
+            if tc["name"] == "db_query_tool":
+                calls[tc["id"]] = tc["args"].get("query")
+        if isinstance(message, ToolMessage) and message.tool_call_id in calls:
+            sql, result = calls[message.tool_call_id], message.content
+    return sql, result
+
+def lookup_answer(question: str, context: str = "") -> Optional[str]:
+    """A cached answer, revalidated by re-running its SQL if the database changed since."""
+    return answer_cache.get(question, context, data_version(),
+                            rerun=lambda sql: db_query_tool.invoke({"query": sql}))
+
+def remember_answer(question: str, context: str, messages, answer: Optional[str]):
+    if answer is None:
+        # The agent gave up without SubmitFinalAnswer; nothing worth serving again
+        return
+    sql, result = executed_sql(messages)
+    answer_cache.put(question, context, data_version(), sql, result, answer)
+
+def ask(question: str, context: str = "") -> str:
+    """Answer a question with db_app, or from the answer cache."""
+    answer = lookup_answer(question, context)
+    if answer is None:
+        prompt = question_prompt(question, context) if context else question
+        messages = db_app.invoke({"messages": [("user", prompt)]})["messages"]
+        answer = final_answer(messages[-1])
+        remember_answer(question, context, messages, answer)
+    return answer
@@ -0,0 +1,294 @@
+"""
+Incremental SQLite index of a repository's git history.
+
+Walks `git log --numstat` once and stores commits, the files each one
+touched and per-file churn in the git_* tables of model.HISTORY_DB, so the
+history agent can answer with SQL instead of forking git for every question.
+Later runs only read the commits made since the last indexed HEAD; if that
+commit is no longer in the history (a rebase, another branch), the index is
+rebuilt.
+
+The same run materializes per-class metrics (last change, commits, authors,
+lines churned) in uml_class_churn, through the history path of each file in
+uml_class.files, for the text-to-SQL agent. Only the classes whose files the
+new commits touched are recomputed, unless the UML data changed since. The
+UML database is only read, so indexing leaves its db_version() alone.
+
+    python history_index.py /path/to/repo
+"""
+import json
+import os
+import subprocess
+import sys
+
+from sqlalchemy import bindparam, delete, inspect, insert, select, text, update
+
+import model
+from git_backend import GitError, git
+from model import GitCommit, GitFileChange, GitFileChurn, GitIndexState, UMLClass, UMLClassFile, UMLClassChurn
+
+GIT_TABLES = [GitCommit.__table__, GitFileChange.__table__, GitFileChurn.__table__, GitIndexState.__table__]
+CLASS_CHURN_TABLES = [UMLClassFile.__table__, UMLClassChurn.__table__]
+# Commits inserted per statement batch while indexing
+INDEX_BATCH_COMMITS = 1000
+# Touched paths whose churn is refreshed per statement
+CHURN_BATCH_PATHS = 500
+# One record per commit: RS, the header fields split by US, NUL, then NUL-terminated numstat entries
+LOG_FORMAT = "%x1e%H%x1f%P%x1f%an%x1f%ae%x1f%at%x1f%ct%x1f%s"
+
+REFRESH_CHURN = f"""
+INSERT INTO {GitFileChurn.__tablename__} (path, commits, added, deleted, authors, first_committed_at, last_committed_at)
+SELECT f.path, COUNT(DISTINCT f.sha), SUM(f.added), SUM(f.deleted), COUNT(DISTINCT c.author_email),
+       MIN(c.committed_at), MAX(c.committed_at)
+FROM {GitFileChange.__tablename__} f JOIN {GitCommit.__tablename__} c ON c.sha = f.sha
+"""
+
+REFRESH_CLASS_CHURN = f"""
+INSERT INTO {UMLClassChurn.__tablename__} (class_id, commits, authors, added, deleted, churned, first_committed_at, last_committed_at)
+SELECT m.class_id, COUNT(DISTINCT f.sha), COUNT(DISTINCT c.author_email), SUM(f.added), SUM(f.deleted),
+       SUM(COALESCE(f.added, 0) + COALESCE(f.deleted, 0)), MIN(c.committed_at), MAX(c.committed_at)
+FROM {UMLClassFile.__tablename__} m
+JOIN {GitFileChange.__tablename__} f ON f.path = m.path
+JOIN {GitCommit.__tablename__} c ON c.sha = f.sha
+"""
+
+
+def is_ancestor(repo_path: str, commit: str, head: str) -> bool:
+    return subprocess.run(
+        ["git", "merge-base", "--is-ancestor", commit, head], cwd=repo_path, capture_output=True
+    ).returncode == 0
+
+
+def parse_commit(record: bytes):
+    """One `git log -z --numstat --format=LOG_FORMAT` record -> (commit row, [file change rows])."""
+    header, _, numstat = record.partition(b"\0")
+    sha, parents, author_name, author_email, authored_at, committed_at, subject = header.decode("utf-8", "replace").split("\x1f", 6)
+    commit = {
+        "sha": sha, "parents": parents, "author_name": author_name, "author_email": author_email,
+        "authored_at": int(authored_at), "committed_at": int(committed_at), "subject": subject,
+    }
+    changes = []
+    entries = iter(numstat.lstrip(b"\n").decode("utf-8", "replace").split("\0"))
+    for entry in entries:
+        if not entry:
+            continue
+        added, deleted, path = entry.split("\t", 2)
+        old_path = None
+        if not path:
+            # Renames and copies: "added\tdeleted\t" NUL old path NUL new path
+            old_path, path = next(entries), next(entries)
+        changes.append({
+            "sha": sha, "path": path, "old_path": old_path,
+            "added": None if added == "-" else int(added),
+            "deleted": None if deleted == "-" else int(deleted),
+        })
+    return commit, changes
+
+
+def read_log(repo_path: str, revisions: str):
+    """Stream the parsed commits of `git log revisions`, newest first."""
+    process = subprocess.Popen(
+        ["git", "log", "-z", "--numstat", "-M", f"--format={LOG_FORMAT}", revisions],
+        cwd=repo_path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    pending = b""
+    for chunk in iter(lambda: process.stdout.read(1 << 16), b""):
+        records = (pending + chunk).split(b"\x1e")
+        pending = records.pop()
+        for record in records:
+            if record:
+                yield parse_commit(record)
+    if pending:
+        yield parse_commit(pending)
+    if process.wait() != 0:
+        raise GitError(f"git log {revisions} failed in {repo_path}")
+
+
+def refresh_churn(conn, paths=None):
+    """Recompute git_file_churn for `paths`, or for every file if None."""
+    if paths is None:
+        conn.execute(delete(GitFileChurn))
+        conn.execute(text(REFRESH_CHURN + " GROUP BY f.path"))
+        return
+    paths = sorted(paths)
+    for start in range(0, len(paths), CHURN_BATCH_PATHS):
+        batch = paths[start:start + CHURN_BATCH_PATHS]
+        conn.execute(delete(GitFileChurn).where(GitFileChurn.path.in_(batch)))
+        conn.execute(
+            text(REFRESH_CHURN + " WHERE f.path IN :paths GROUP BY f.path").bindparams(bindparam("paths", expanding=True)),
+            {"paths": batch}
+        )
+
+
+def class_files(uml_engine) -> list:
+    """(class id, source file) of every uml_class.files entry, with "/" separators."""
+    sources = []
+    with uml_engine.connect() as conn:
+        for class_id, files in conn.execute(select(UMLClass.id, UMLClass.files)):
+            try:
+                paths = json.loads(files or "[]")
+            except ValueError:
+                continue
+            sources.extend((class_id, path.replace("\\", "/")) for path in paths)
+    return sources
+
+
+def history_path(source: str, paths) -> str:
+    """
+    The longest of the history `paths` that `source` ends with: the extractor
+    may have stored absolute paths or paths under another checkout root.
+    """
+    matches = [path for path in paths if source == path or source.endswith("/" + path)]
+    return max(matches, key=len) if matches else None
+
+
+def refresh_class_churn(conn, sources: list, touched=None):
+    """
+    Recompute uml_class_churn for the classes with a file among the history
+    paths `touched`, first matching each class file (class_files `sources`)
+    whose name one of them has, or remap and recompute every class if None.
+    """
+    if touched is None:
+        by_name = {}
+        for (path,) in conn.execute(select(GitFileChurn.path)):
+            by_name.setdefault(path.rsplit("/", 1)[-1], []).append(path)
+        mapping = set()
+        for class_id, source in sources:
+            path = history_path(source, by_name.get(source.rsplit("/", 1)[-1], ()))
+            if path is not None:
+                mapping.add((class_id, path))
+        conn.execute(delete(UMLClassFile))
+        if mapping:
+            conn.execute(insert(UMLClassFile), [{"class_id": class_id, "path": path} for class_id, path in mapping])
+        conn.execute(delete(UMLClassChurn))
+        conn.execute(text(REFRESH_CLASS_CHURN + " GROUP BY m.class_id"))
+        return
+
+    by_name = {}
+    for path in touched:
+        by_name.setdefault(path.rsplit("/", 1)[-1], []).append(path)
+    current = {}
+    for class_id, path in conn.execute(select(UMLClassFile.class_id, UMLClassFile.path)):
+        current.setdefault(class_id, set()).add(path)
+    # A class file matched nothing, or a shorter suffix, until its path first appeared in these commits
+    for class_id, source in sources:
+        candidates = by_name.get(source.rsplit("/", 1)[-1])
+        if not candidates:
+            continue
+        path = history_path(source, candidates)
+        if path is None or path in current.get(class_id, ()):
+            continue
+        mapped = history_path(source, current.get(class_id, ()))
+        if mapped is not None and len(mapped) > len(path):
+            continue
+        if mapped is not None:
+            conn.execute(delete(UMLClassFile).where(UMLClassFile.class_id == class_id, UMLClassFile.path == mapped))
+            current[class_id].discard(mapped)
+        conn.execute(insert(UMLClassFile).values(class_id=class_id, path=path))
+        current.setdefault(class_id, set()).add(path)
+
+    class_ids = sorted(class_id for class_id, paths in current.items() if not paths.isdisjoint(touched))
+    for start in range(0, len(class_ids), CHURN_BATCH_PATHS):
+        batch = class_ids[start:start + CHURN_BATCH_PATHS]
+        conn.execute(delete(UMLClassChurn).where(UMLClassChurn.class_id.in_(batch)))
+        conn.execute(
+            text(REFRESH_CLASS_CHURN + " WHERE m.class_id IN :ids GROUP BY m.class_id").bindparams(bindparam("ids", expanding=True)),
+            {"ids": batch}
+        )
+
+
+def remap_classes(engine=None, uml_engine=None) -> bool:
+    """
+    Re-map uml_class_churn (in `engine`) onto the classes of `uml_engine` if
+    the UML data changed since it was built, without reading git. Returns
+    whether there is class churn matching the current UML data: False until
+    a repository was indexed or while there is no UML data.
+    """
+    engine = engine or model.history_engine
+    uml_engine = uml_engine or model.engine
+    if not os.path.exists(engine.url.database) or not os.path.exists(uml_engine.url.database):
+        return False
+    if not inspect(engine).has_table(GitIndexState.__tablename__) or not inspect(uml_engine).has_table(UMLClass.__tablename__):
+        return False
+    uml_version = model.db_version(uml_engine.url.database)
+    with engine.begin() as conn:
+        state = conn.execute(select(GitIndexState.uml_version)).first()
+        if state is None:
+            return False
+        if state.uml_version != uml_version:
+            refresh_class_churn(conn, class_files(uml_engine))
+            conn.execute(update(GitIndexState).values(uml_version=uml_version))
+    return True
+
+
+def flush(conn, commits: list, changes: list) -> int:
+    count = len(commits)
+    if commits:
+        conn.execute(insert(GitCommit), commits)
+    if changes:
+        conn.execute(insert(GitFileChange), changes)
+    commits.clear()
+    changes.clear()
+    return count
+
+
+def update_history_index(repo_path: str, engine=None, uml_engine=None) -> int:
+    """
+    Bring the git_* tables (in `engine`, model.history_engine by default) up
+    to date with the HEAD of `repo_path`, and uml_class_churn with the classes
+    of `uml_engine` (model.engine), and return the number of commits added.
+    Costs one `git rev-parse` when nothing changed.
+    """
+    engine = engine or model.history_engine
+    uml_engine = uml_engine or model.engine
+    repo = os.path.realpath(repo_path)
+    head = git(repo, "rev-parse", "HEAD")
+    with engine.connect() as conn:
+        # Persistent; lets the agents read the index while it is updated
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+    model.Base.metadata.create_all(engine, tables=GIT_TABLES + CLASS_CHURN_TABLES)
+    with_classes = os.path.exists(uml_engine.url.database) and inspect(uml_engine).has_table(UMLClass.__tablename__)
+    uml_version = model.db_version(uml_engine.url.database) if with_classes else None
+
+    with engine.begin() as conn:
+        state = conn.execute(select(GitIndexState.repo, GitIndexState.head, GitIndexState.uml_version)).first()
+        same_repo = state is not None and state.repo == repo
+        classes_current = same_repo and state.uml_version == uml_version
+        if same_repo and state.head == head:
+            if with_classes and not classes_current:
+                refresh_class_churn(conn, class_files(uml_engine))
+                conn.execute(update(GitIndexState).values(uml_version=uml_version))
+            return 0
+        if same_repo and state.head and is_ancestor(repo, state.head, head):
+            revisions, touched = f"{state.head}..{head}", set()
+        else:
+            for table in reversed(GIT_TABLES):
+                conn.execute(delete(table))
+            revisions, touched = head, None
+
+        added = 0
+        commits, changes = [], []
+        for commit, commit_changes in read_log(repo, revisions):
+            commits.append(commit)
+            changes.extend(commit_changes)
+            if touched is not None:
+                touched.update(change["path"] for change in commit_changes)
+            if len(commits) >= INDEX_BATCH_COMMITS:
+                added += flush(conn, commits, changes)
+        added += flush(conn, commits, changes)
+
+        refresh_churn(conn, touched)
+        if with_classes:
+            refresh_class_churn(conn, class_files(uml_engine), touched if classes_current else None)
+        conn.execute(delete(GitIndexState))
+        conn.execute(insert(GitIndexState).values(repo=repo, head=head, uml_version=uml_version))
+        if added:
+            for table in GIT_TABLES + CLASS_CHURN_TABLES:
+                conn.exec_driver_sql(f"ANALYZE {table.name}")
+    return added
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    model.migrate_schema(model.engine)
+    print(f"{update_history_index(sys.argv[1])} commits indexed")
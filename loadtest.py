@@ -0,0 +1,87 @@
+"""
+Load test for the diagram endpoints of a running server.
+
+Simulates clients browsing the package tree the way the front end does:
+each client opens a package and follows the `on_click` links it returns.
+Latency is reported for a single client and for `--clients` browsing at once.
+
+    uvicorn simple:app --port 8000
+    python loadtest.py --url http://localhost:8000 --clients 50
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import httpx
+
+
+async def discover(client: httpx.AsyncClient, limit: int):
+    """Walk the package tree breadth-first and return up to `limit` browse paths."""
+    paths, queue, seen = [], ["packages?package="], set()
+    while queue and len(paths) < limit:
+        path = queue.pop(0)
+        if path in seen:
+            continue
+        seen.add(path)
+        paths.append(path)
+        if path.startswith("packages"):
+            response = await client.get(f"/data/{path}")
+            response.raise_for_status()
+            queue.extend(pkg["on_click"] for pkg in response.json()["data"]["packages"])
+    return paths
+
+
+async def browse(client: httpx.AsyncClient, paths: list, requests: int, seed: int, latencies: list):
+    rnd = random.Random(seed)
+    for _ in range(requests):
+        path = rnd.choice(paths)
+        start = time.perf_counter()
+        response = await client.get(f"/data/{path}")
+        response.raise_for_status()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def run_phase(url: str, paths: list, clients: int, requests: int):
+    latencies = []
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(base_url=url, timeout=120, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(browse(client, paths, requests, seed, latencies) for seed in range(clients)))
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def percentile(values: list, pct: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def report(label: str, latencies: list, elapsed: float):
+    print(
+        f"{label:<12} n={len(latencies):<5} "
+        f"p50={percentile(latencies, 50):8.1f} ms  p95={percentile(latencies, 95):8.1f} ms  "
+        f"p99={percentile(latencies, 99):8.1f} ms  mean={statistics.mean(latencies):8.1f} ms  "
+        f"throughput={len(latencies) / elapsed:7.1f} req/s"
+    )
+
+
+async def main(args):
+    async with httpx.AsyncClient(base_url=args.url, timeout=120) as client:
+        paths = await discover(client, args.paths)
+    print(f"browsing {len(paths)} package views\n")
+
+    solo, solo_elapsed = await run_phase(args.url, paths, 1, args.requests * 2)
+    report("1 client", solo, solo_elapsed)
+    crowd, crowd_elapsed = await run_phase(args.url, paths, args.clients, args.requests)
+    report(f"{args.clients} clients", crowd, crowd_elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=20, help="requests per client")
+    parser.add_argument("--paths", type=int, default=200, help="package views to browse")
+    asyncio.run(main(parser.parse_args()))
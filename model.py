@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Text, ForeignKey
+import os
+from sqlalchemy import create_engine, inspect, select, update, bindparam, Column, Integer, String, Boolean, Text, LargeBinary, ForeignKey, Index
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 
 Base = declarative_base()
@@ -20,6 +21,10 @@ class UMLClass(Base):
     properties = relationship("UMLProperty", back_populates="uml_class")
     methods = relationship("UMLMethod", back_populates="uml_class")
 
+    __table_args__ = (
+        Index("ix_uml_class_package_name", "package_name", "name"),
+    )
+
 class UMLProperty(Base):
     __tablename__ = 'uml_property'
     id = Column(Integer, primary_key=True)
@@ -37,6 +42,10 @@ class UMLProperty(Base):
 
     uml_class = relationship("UMLClass", back_populates="properties")
 
+    __table_args__ = (
+        Index("ix_uml_property_class_id", "class_id"),
+    )
+
 class UMLMethod(Base):
     __tablename__ = 'uml_method'
     id = Column(Integer, primary_key=True)
@@ -58,6 +67,11 @@ class UMLMethod(Base):
     uml_class = relationship("UMLClass", back_populates="methods")
     parameters = relationship("UMLParameter", back_populates="method")
 
+    __table_args__ = (
+        # Covers the class-diagram loader so it never touches rows carrying `source`
+        Index("ix_uml_method_class_id", "class_id", "id", "name", "return_type", "visibility", "is_static", "is_abstract"),
+    )
+
 class UMLParameter(Base):
     __tablename__ = 'uml_parameter'
     id = Column(Integer, primary_key=True)
@@ -72,6 +86,10 @@ class UMLParameter(Base):
 
     method = relationship("UMLMethod", back_populates="parameters")
 
+    __table_args__ = (
+        Index("ix_uml_parameter_method_id", "method_id"),
+    )
+
 class UMLRelationship(Base):
     __tablename__ = "uml_relationship"
     id = Column(Integer, primary_key=True)
@@ -79,19 +97,219 @@ class UMLRelationship(Base):
     target = Column(String)
     name = Column(String)
     type = Column(String)
-    
+    # source/target resolved to uml_class ids by link_relationships
+    source_id = Column(Integer, ForeignKey('uml_class.id'))
+    target_id = Column(Integer, ForeignKey('uml_class.id'))
+
+    __table_args__ = (
+        Index("ix_uml_relationship_source", "source"),
+        Index("ix_uml_relationship_target", "target"),
+        Index("ix_uml_relationship_source_id", "source_id"),
+        Index("ix_uml_relationship_target_id", "target_id"),
+    )
+
 class UMLPackage(Base):
     __tablename__ = "uml_package"
     id = Column(Integer, primary_key=True)
     name = Column(String)
     parent = Column(String)
-    
+
+    __table_args__ = (
+        Index("ix_uml_package_parent", "parent", "name"),
+    )
+
+class UMLPackageDependency(Base):
+    """Package-to-package edges rolled up from uml_relationship."""
+    __tablename__ = "uml_package_dependency"
+    id = Column(Integer, primary_key=True)
+    source_package = Column(String, nullable=False)
+    target_package = Column(String, nullable=False)
+    type = Column(String)
+    label = Column(String)
+    edge_count = Column(Integer)
+    first_relationship_id = Column(Integer)
+
+    __table_args__ = (
+        Index("ix_uml_package_dependency_pair", "source_package", "target_package"),
+    )
+
+class UMLSnapshot(Base):
+    """Pre-rendered, compressed /data payloads per (endpoint, package); built by snapshot.py."""
+    __tablename__ = "uml_snapshot"
+    endpoint = Column(String, primary_key=True)
+    package = Column(String, primary_key=True)  # "" for the root view
+    body = Column(LargeBinary, nullable=False)
+
+class UMLRollupState(Base):
+    """One row per derived table; set dirty by triggers when its inputs change."""
+    __tablename__ = "uml_rollup_state"
+    name = Column(String, primary_key=True)
+    dirty = Column(Boolean)
+
+
+# === Git History Index (built by history_index.py) ===
+# Stored in HISTORY_DB, not uml-data.db, so indexing never changes db_version()
+# of the UML data; the agents' engines attach it (see common.agent_engine).
+
+class GitCommit(Base):
+    __tablename__ = "git_commit"
+    sha = Column(String, primary_key=True)
+    parents = Column(String)  # space-separated shas
+    author_name = Column(String)
+    author_email = Column(String, index=True)
+    authored_at = Column(Integer)  # unix time
+    committed_at = Column(Integer, index=True)
+    subject = Column(Text)
+
+class GitFileChange(Base):
+    """One row per file touched by a commit, with its --numstat line counts (NULL for binary files)."""
+    __tablename__ = "git_file_change"
+    id = Column(Integer, primary_key=True)
+    sha = Column(String, ForeignKey("git_commit.sha"), index=True)
+    path = Column(String, index=True)
+    old_path = Column(String)  # set when the change is a rename
+    added = Column(Integer)
+    deleted = Column(Integer)
+
+class GitFileChurn(Base):
+    """Per-file totals over git_file_change, refreshed for the files each indexing run touches."""
+    __tablename__ = "git_file_churn"
+    path = Column(String, primary_key=True)
+    commits = Column(Integer)
+    added = Column(Integer)
+    deleted = Column(Integer)
+    authors = Column(Integer)
+    first_committed_at = Column(Integer)
+    last_committed_at = Column(Integer)
+
+class GitIndexState(Base):
+    """The repository the history index was built from, the last commit indexed and the UML data the classes were mapped on."""
+    __tablename__ = "git_index_state"
+    repo = Column(String, primary_key=True)
+    head = Column(String)
+    uml_version = Column(String)  # db_version() of the UML database
+
+class UMLClassFile(Base):
+    """The path in the git history of each source file of a class (uml_class.files)."""
+    __tablename__ = "uml_class_file"
+    class_id = Column(Integer, primary_key=True)  # uml_class.id, in the UML database
+    path = Column(String, primary_key=True, index=True)
+
+class UMLClassChurn(Base):
+    """Per-class totals over the git history of its source files, refreshed for the classes each indexing run touches."""
+    __tablename__ = "uml_class_churn"
+    class_id = Column(Integer, primary_key=True)  # uml_class.id, in the UML database
+    commits = Column(Integer)
+    authors = Column(Integer)
+    added = Column(Integer)
+    deleted = Column(Integer)
+    churned = Column(Integer)  # added + deleted
+    first_committed_at = Column(Integer)  # unix time
+    last_committed_at = Column(Integer, index=True)  # unix time of the last commit touching the class
+
 
 # === Connect and Extract Data ===
 
 engine = create_engine('sqlite:///uml-data.db')
+HISTORY_DB = os.getenv("HISTORY_DB", "uml-history.db")
+history_engine = create_engine(f"sqlite:///{HISTORY_DB}")
+# One short-lived session per call, so requests can run on worker threads concurrently
 Session = sessionmaker(bind=engine)
-session = Session()
+
+def db_version(database: str = None):
+    """
+    Version stamp of the UML database (or of the SQLite file `database`): mtime
+    and size of the file and its WAL. Changes whenever anything (the
+    extractor, a rollup rebuild) writes to it.
+    """
+    database = database or engine.url.database
+    stamps = []
+    for path in (database, database + "-wal"):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        stamps.append(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    return ".".join(stamps)
+
+# === Schema Migrations ===
+# uml-data.db is written by the extractor without indexes; each step below moves
+# it up one version, and PRAGMA user_version records the last step applied.
+
+def create_indexes(conn, names):
+    existing_tables = set(inspect(conn).get_table_names())
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in names and table.name in existing_tables:
+                index.create(conn, checkfirst=True)
+
+def link_relationships(conn):
+    """
+    Resolve uml_relationship.source/target fully-qualified names to uml_class
+    ids through one in-memory FQCN -> id map, updating only the rows whose
+    link changed. Works on a Session or a Connection.
+    """
+    class_ids = {
+        f"{pkg}.{name}" if pkg else name: class_id
+        for class_id, name, pkg in conn.execute(select(UMLClass.id, UMLClass.name, UMLClass.package_name))
+    }
+    relationships = conn.execute(
+        select(UMLRelationship.id, UMLRelationship.source, UMLRelationship.target,
+               UMLRelationship.source_id, UMLRelationship.target_id)
+    ).all()
+
+    changes = []
+    for r in relationships:
+        source_id = class_ids.get(r.source)
+        target_id = class_ids.get(r.target)
+        if source_id != r.source_id or target_id != r.target_id:
+            changes.append({"rel_id": r.id, "new_source_id": source_id, "new_target_id": target_id})
+
+    if changes:
+        relationship_table = UMLRelationship.__table__
+        conn.execute(
+            update(relationship_table)
+            .where(relationship_table.c.id == bindparam("rel_id"))
+            .values(source_id=bindparam("new_source_id"), target_id=bindparam("new_target_id")),
+            changes
+        )
+
+def create_access_path_indexes(conn):
+    create_indexes(conn, [
+        "ix_uml_class_package_name", "ix_uml_package_parent",
+        "ix_uml_relationship_source", "ix_uml_relationship_target",
+        "ix_uml_method_class_id", "ix_uml_property_class_id", "ix_uml_parameter_method_id",
+    ])
+
+def add_relationship_class_ids(conn):
+    inspector = inspect(conn)
+    if not inspector.has_table("uml_relationship"):
+        return
+    columns = {column["name"] for column in inspector.get_columns("uml_relationship")}
+    for column in ("source_id", "target_id"):
+        if column not in columns:
+            conn.exec_driver_sql(f"ALTER TABLE uml_relationship ADD COLUMN {column} INTEGER REFERENCES uml_class(id)")
+    create_indexes(conn, ["ix_uml_relationship_source_id", "ix_uml_relationship_target_id"])
+    link_relationships(conn)
+
+MIGRATIONS = [
+    create_access_path_indexes,
+    add_relationship_class_ids,
+]
+
+def migrate_schema(engine):
+    """Apply pending MIGRATIONS in order, then refresh the planner statistics."""
+    with engine.connect() as conn:
+        # Persistent; lets the agents' read-only readers run alongside writes
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        if version >= len(MIGRATIONS):
+            return
+        for step in MIGRATIONS[version:]:
+            step(conn)
+        conn.exec_driver_sql("ANALYZE")
+        conn.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
 
 # # Print UML classes and related elements
 # for uml_class in session.query(UMLClass).all():
@@ -108,87 +326,355 @@ session = Session()
 # from sqlalchemy import create_engine
 # from sqlalchemy.orm import sessionmaker
 import json
-from sqlalchemy import or_
-def get_classes(package_name: str):
+import threading
+from collections import defaultdict
+import orjson
+from sqlalchemy import or_, delete, insert, text
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import OperationalError
+
+def stored_json(value):
+    """
+    A JSON column as stored by the extractor, wrapped so orjson splices it
+    into the response verbatim instead of it being parsed and re-encoded.
+    """
+    return orjson.Fragment(value) if value else []
+
+# Payload fields a fields= path may descend into, with their own nested fields; every other field is a leaf
+NESTED_FIELDS = {"properties": {}, "methods": {"parameters": {}}, "relationships": {}}
+
+def parse_fields(fields: str):
+    """
+    Parse a fields= projection such as "id,name,methods.name" into a tree,
+    {"id": None, "name": None, "methods": {"name": None}}, where None selects
+    the whole value. Returns None (everything) for an empty projection.
+    Raises ValueError for a path that goes below a leaf, e.g. "name.x".
+    """
+    if not fields:
+        return None
+    tree = {}
+    for path in fields.split(","):
+        parts = [part.strip() for part in path.split(".") if part.strip()]
+        nested = NESTED_FIELDS
+        for part in parts[:-1]:
+            if part not in nested:
+                raise ValueError(f"{path.strip()!r}: {part!r} has no fields to select")
+            nested = nested[part]
+        node = tree
+        for i, part in enumerate(parts):
+            if i == len(parts) - 1:
+                node[part] = None
+                break
+            child = node.get(part, {})
+            if child is None:
+                break
+            node[part] = child
+            node = child
+    return tree
+
+def project(value, spec):
+    """Keep only the keys of `value` (a dict or list of dicts) selected by a parse_fields tree."""
+    if spec is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, spec) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {key: project(item, spec[key]) for key, item in value.items() if key in spec}
+
+def load_class_members(session, class_filter, properties=True, methods=True, parameters=True):
+    """
+    Batch-load the properties, methods and parameters of every class matching
+    `class_filter` with one set-based query per table, instead of lazy-loading
+    them class by class. Returns (properties, methods) dicts keyed by class id;
+    tables switched off by the flags are not queried.
+    """
+    class_ids = select(UMLClass.id).where(*class_filter)
+    load_properties, load_methods, load_parameters = properties, methods, methods and parameters
+
+    properties = defaultdict(list)
+    prop_rows = [] if not load_properties else session.execute(
+        select(UMLProperty.class_id, UMLProperty.name, UMLProperty.data_type, UMLProperty.visibility,
+               UMLProperty.is_static, UMLProperty.is_final)
+        .where(UMLProperty.class_id.in_(class_ids))
+        .order_by(UMLProperty.id)
+    )
+    for prop in prop_rows:
+        properties[prop.class_id].append({
+            "name": prop.name,
+            "dataType": prop.data_type,
+            "annotations": "",#json.loads(prop.annotations) if prop.annotations else [],
+            "visibility": prop.visibility,
+            "isStatic": bool(prop.is_static),
+            "isFinal": bool(prop.is_final)
+        })
+
+    methods = defaultdict(list)
+    method_parameters = {}
+    method_rows = [] if not load_methods else session.execute(
+        select(UMLMethod.id, UMLMethod.class_id, UMLMethod.name, UMLMethod.return_type, UMLMethod.visibility,
+               UMLMethod.is_static, UMLMethod.is_abstract)
+        .where(UMLMethod.class_id.in_(class_ids))
+        .order_by(UMLMethod.id)
+    )
+    for method in method_rows:
+        method_parameters[method.id] = []
+        methods[method.class_id].append({
+            "name": method.name,
+            "returnType": method.return_type,
+            "annotations": "",#json.loads(method.annotations) if method.annotations else [],
+            "visibility": method.visibility,
+            "isStatic": bool(method.is_static),
+            "isAbstract": bool(method.is_abstract),
+            "parameters": method_parameters[method.id]
+        })
+
+    param_rows = [] if not load_parameters else session.execute(
+        select(UMLParameter.method_id, UMLParameter.name, UMLParameter.data_type, UMLParameter.annotations)
+        .join(UMLMethod, UMLParameter.method_id == UMLMethod.id)
+        .where(UMLMethod.class_id.in_(class_ids))
+        .order_by(UMLParameter.id)
+    )
+    for param in param_rows:
+        method_parameters[param.method_id].append({
+            "name": param.name,
+            "dataType": param.data_type,
+            "annotations": stored_json(param.annotations)
+        })
+
+    return properties, methods
+
+# Class payload fields in output order: the uml_class columns each reads, and how it is built
+CLASS_FIELDS = {
+    "type": ([], lambda cls: "class"),
+    "annotations": ([], lambda cls: ""),#json.loads(cls.annotations) if cls.annotations else [],
+    "id": (["package_name", "name"], lambda cls: f"{cls.package_name}.{cls.name}"),
+    "domId": (["dom_id"], lambda cls: cls.dom_id or ""),
+    "name": (["name"], lambda cls: cls.name),
+    "package": (["package_name"], lambda cls: cls.package_name),
+    "seleced": ([], lambda cls: False),
+    "style": ([], lambda cls: ""),
+    "generatedContent": ([], lambda cls: ""),
+    "files": (["files"], lambda cls: stored_json(cls.files)),
+    "isAbstract": (["is_abstract"], lambda cls: bool(cls.is_abstract)),
+    "isInterface": (["is_interface"], lambda cls: bool(cls.is_interface)),
+}
+
+def class_columns(spec):
+    """uml_class columns needed to build the fields selected by `spec`, id first."""
+    names = ["id"]
+    for key, (columns, _) in CLASS_FIELDS.items():
+        if spec is None or key in spec:
+            names.extend(column for column in columns if column not in names)
+    return [getattr(UMLClass, name) for name in names]
+
+def class_to_dict(cls, properties, methods, spec=None):
+    result = {key: build(cls) for key, (_, build) in CLASS_FIELDS.items() if spec is None or key in spec}
+    if spec is None or "properties" in spec:
+        result["properties"] = project(properties.get(cls.id, []), spec and spec["properties"])
+    if spec is None or "methods" in spec:
+        result["methods"] = project(methods.get(cls.id, []), spec and spec["methods"])
+    return result
+
+def relationship_to_dict(rls):
+    return {
+        "id": f"{rls.id}",
+        # "domId": rls.dom_id or "",
+        "name": rls.name,
+        "source": rls.source,
+        "target": rls.target,
+        "type": rls.type
+    }
+
+def package_relationships(session, class_filter):
+    """Relationships with either end among the classes matching `class_filter`."""
+    class_ids = select(UMLClass.id).where(*class_filter)
+    return session.query(UMLRelationship).filter(
+        or_(UMLRelationship.source_id.in_(class_ids), UMLRelationship.target_id.in_(class_ids))
+    ).order_by(UMLRelationship.id)
+
+def get_classes(package_name: str, limit: int = None, cursor: int = None, fields: str = None):
+    """
+    Classes of a package (all classes when None) with their members and relationships.
+
+    limit/cursor page through the classes in id order: pass the returned
+    "nextCursor" back as `cursor`, it is None on the last page; relationships
+    are those touching the page's classes. `fields` (see parse_fields) selects
+    class fields, plus "relationships"; unselected columns and tables are not read.
+
+    Stored JSON columns (class files, parameter annotations) come back as
+    orjson.Fragment, so encode the result with orjson.
+    """
+    if limit is not None and limit < 1:
+        raise ValueError(f"limit must be at least 1, got {limit}")
+    with Session() as session:
+        ensure_package_rollup(session)
+        return class_page(session, package_name, limit, cursor, fields)
+
+def class_page(session, package_name: str, limit: int = None, cursor: int = None, fields: str = None):
+    """get_classes on an open session, without touching the package rollup."""
+    spec = parse_fields(fields)
+    wants = lambda key: spec is None or key in spec
     result = {
         "type": "class",
         "classes": [],
         "relationships":[]
     }
 
-    if not package_name:
-        classes = session.query(UMLClass).all()
+    class_filter = [UMLClass.package_name == package_name] if package_name else []
+    if cursor is not None:
+        class_filter.append(UMLClass.id > cursor)
+    query = select(*class_columns(spec)).where(*class_filter).order_by(UMLClass.id)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    classes = session.execute(query).all()
+
+    if limit is not None:
+        has_more = len(classes) > limit
+        classes = classes[:limit]
+        result["nextCursor"] = classes[-1].id if has_more else None
+        if classes:
+            class_filter.append(UMLClass.id <= classes[-1].id)
+
+    # An empty page touches no relationships; unfiltered, the query below would read them all
+    if not classes or not wants("relationships"):
+        relationships = []
+    elif not class_filter:
         relationships = session.query(UMLRelationship).all()    
     else:
-        classes = session.query(UMLClass).filter(UMLClass.package_name == package_name).all()
-        class_names = [f"{cls.package_name}.{cls.name}" for cls in classes]
-        relationships = session.query(UMLRelationship).filter( or_( UMLRelationship.source.in_(class_names), UMLRelationship.target.in_(class_names) )).all()
-    
-    for cls in classes:
-        class_dict = {
-            "type": "class",
-            "annotations": "",#json.loads(cls.annotations) if cls.annotations else [],
-            "id": f"{cls.package_name}.{cls.name}",
-            "domId": cls.dom_id or "",
-            "name": cls.name,
-            "package": cls.package_name,
-            "seleced": False,
-            "style": "",
-            "generatedContent": "",
-            "files": json.loads(cls.files) if cls.files else [],
-            "isAbstract": bool(cls.is_abstract),
-            "isInterface": bool(cls.is_interface),
-            "properties": [],
-            "methods": []
-        }
-
-        for prop in cls.properties:
-            class_dict["properties"].append({
-                "name": prop.name,
-                "dataType": prop.data_type,
-                "annotations": "",#json.loads(prop.annotations) if prop.annotations else [],
-                "visibility": prop.visibility,
-                "isStatic": bool(prop.is_static),
-                "isFinal": bool(prop.is_final)
-            })
-
-        for method in cls.methods:
-            method_dict = {
-                "name": method.name,
-                "returnType": method.return_type,
-                "annotations": "",#json.loads(method.annotations) if method.annotations else [],
-                "visibility": method.visibility,
-                "isStatic": bool(method.is_static),
-                "isAbstract": bool(method.is_abstract),
-                "parameters": []
-            }
-
-            for param in method.parameters:
-                method_dict["parameters"].append({
-                    "name": param.name,
-                    "dataType": param.data_type,
-                    "annotations": json.loads(param.annotations) if param.annotations else []
-                })
+        relationships = package_relationships(session, class_filter).all()
 
-            class_dict["methods"].append(method_dict)
+    method_spec = spec and spec.get("methods")
+    properties, methods = load_class_members(
+        session, class_filter,
+        properties=bool(classes) and wants("properties"),
+        methods=bool(classes) and wants("methods"),
+        parameters=method_spec is None or "parameters" in method_spec
+    )
 
-        result["classes"].append(class_dict)
+    for cls in classes:
+        result["classes"].append(class_to_dict(cls, properties, methods, spec))
     for rls in relationships:
-        rls_dict = {
-            "id": f"{rls.id}",
-            # "domId": rls.dom_id or "",
-            "name": rls.name,
-            "source": rls.source,
-            "target": rls.target,
-            "type": rls.type
-        }
-        result["relationships"].append(rls_dict)
-    session.close()
+        result["relationships"].append(project(relationship_to_dict(rls), spec and spec["relationships"]))
     return result
+
+def iter_classes(package_name: str, batch_size: int = 500):
+    """
+    Stream what get_classes returns as ("class", dict) items followed by
+    ("relationship", dict) items. Classes are read in keyset batches of
+    `batch_size` and relationships through a streaming cursor, so memory
+    stays flat however large the repository is.
+    """
+    with Session() as session:
+        ensure_package_rollup(session)
+        class_filter = [UMLClass.package_name == package_name] if package_name else []
+
+        last_id = None
+        while True:
+            batch_filter = class_filter + ([UMLClass.id > last_id] if last_id is not None else [])
+            classes = session.query(UMLClass).filter(*batch_filter).order_by(UMLClass.id).limit(batch_size).all()
+            if not classes:
+                break
+            last_id = classes[-1].id
+            properties, methods = load_class_members(session, batch_filter + [UMLClass.id <= last_id])
+            for cls in classes:
+                yield "class", class_to_dict(cls, properties, methods)
+
+        if package_name:
+            relationships = package_relationships(session, class_filter)
+        else:
+            relationships = session.query(UMLRelationship).order_by(UMLRelationship.id)
+        for rls in relationships.yield_per(1000):
+            yield "relationship", relationship_to_dict(rls)
 # output = json.dumps(get_classes_by_package("org.keycloak.themeverifier"), indent=2)
 
 
+# Any change to relationships, or to the classes they resolve to, invalidates the rollups.
+ROLLUP_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_rollup AFTER {op} ON {table} "
+    f"BEGIN UPDATE uml_rollup_state SET dirty = 1; END"
+    for table in ("uml_relationship", "uml_class")
+    for op in ("INSERT", "UPDATE", "DELETE")
+]
+
+def build_package_rollup(session):
+    """
+    Re-link relationships to class ids and rebuild uml_package_dependency:
+    every class-level relationship whose ends live in two different packages
+    becomes one edge per (source, target) package pair, labelled after its
+    first relationship and counting them all.
+    """
+    bind = session.get_bind()
+    Base.metadata.create_all(bind, tables=[UMLPackageDependency.__table__, UMLRollupState.__table__])
+    for trigger in ROLLUP_TRIGGERS:
+        session.execute(text(trigger))
+
+    link_relationships(session)
+
+    source_class = aliased(UMLClass)
+    target_class = aliased(UMLClass)
+    edges = {}
+    relationships = session.execute(
+        select(UMLRelationship.id, UMLRelationship.name, UMLRelationship.type,
+               source_class.package_name.label("source_package"), target_class.package_name.label("target_package"))
+        .join(source_class, source_class.id == UMLRelationship.source_id)
+        .join(target_class, target_class.id == UMLRelationship.target_id)
+        .where(source_class.package_name != "", target_class.package_name != "",
+               source_class.package_name != target_class.package_name)
+        .order_by(UMLRelationship.id)
+    )
+    for r in relationships:
+        src_pkg, tgt_pkg = r.source_package, r.target_package
+        edge = edges.get((src_pkg, tgt_pkg))
+        if edge is None:
+            edges[(src_pkg, tgt_pkg)] = {
+                "source_package": src_pkg,
+                "target_package": tgt_pkg,
+                "type": r.type,
+                "label": r.name or "",
+                "edge_count": 1,
+                "first_relationship_id": r.id
+            }
+        else:
+            edge["edge_count"] += 1
+
+    session.execute(delete(UMLPackageDependency))
+    if edges:
+        session.execute(insert(UMLPackageDependency), list(edges.values()))
+    session.merge(UMLRollupState(name="package_dependency", dirty=False))
+    session.commit()
+
+def package_rollup_is_current(session):
+    try:
+        dirty = session.execute(
+            select(UMLRollupState.dirty).where(UMLRollupState.name == "package_dependency")
+        ).scalar_one_or_none()
+    except OperationalError:
+        session.rollback()
+        return False
+    return dirty is not None and not dirty
+
+# Serializes rebuilds between concurrent requests
+rollup_lock = threading.Lock()
+
+def ensure_package_rollup(session):
+    """Re-link relationships and rebuild the package rollup if missing or its inputs changed since the last build."""
+    if package_rollup_is_current(session):
+        return
+    with rollup_lock:
+        if not package_rollup_is_current(session):
+            build_package_rollup(session)
+
 def get_packages(package_name: str):
+    with Session() as session:
+        ensure_package_rollup(session)
+        return package_listing(session, package_name)
+
+def package_listing(session, package_name: str, dependencies: bool = True):
+    """
+    get_packages on an open session, without touching the package rollup;
+    package-level edges are read from it only when `dependencies` is set.
+    """
     result = {
         "type": "package",
         "id": package_name or "",
@@ -200,26 +686,21 @@ def get_packages(package_name: str):
 
     # 1. Fetch classes and subpackages
     if not package_name:
-        classes = session.query(UMLClass).filter(UMLClass.package_name.is_(None)).all()
-        subpackages = session.query(UMLPackage).filter(UMLPackage.parent.is_(None)).all()
+        classes = session.query(UMLClass).filter(UMLClass.package_name.is_(None)).order_by(UMLClass.id).all()
+        subpackages = session.query(UMLPackage).filter(UMLPackage.parent.is_(None)).order_by(UMLPackage.id).all()
     else:
-        classes = session.query(UMLClass).filter(UMLClass.package_name == package_name).all()
-        subpackages = session.query(UMLPackage).filter(UMLPackage.parent == package_name).all()
+        classes = session.query(UMLClass).filter(UMLClass.package_name == package_name).order_by(UMLClass.id).all()
+        subpackages = session.query(UMLPackage).filter(UMLPackage.parent == package_name).order_by(UMLPackage.id).all()
 
-    # 2. Build class → package map
-    package_scope_class_map = {}
-    all_package_names = set()
+    # 2. Packages in scope: this one plus its direct subpackages
+    subpackage_names = [f"{subpkg.parent}.{subpkg.name}" if subpkg.parent else subpkg.name for subpkg in subpackages]
+    scope_packages = [package_name or ""] + subpackage_names
+    parents_with_children = set(session.execute(
+        select(UMLPackage.parent).where(UMLPackage.parent.in_(subpackage_names)).distinct()
+    ).scalars())
 
-    for cls in classes:
-        fqcn = f"{cls.package_name}.{cls.name}" if cls.package_name else cls.name
-        pkg = cls.package_name or ""
-        package_scope_class_map[fqcn] = pkg
-        all_package_names.add(pkg)
-
-    for subpkg in subpackages:
-        full_pkg = f"{subpkg.parent}.{subpkg.name}" if subpkg.parent else subpkg.name
-        has_children = session.query(UMLPackage).filter(UMLPackage.parent == full_pkg).first() is not None
-        all_package_names.add(full_pkg)
+    for subpkg, full_pkg in zip(subpackages, subpackage_names):
+        has_children = full_pkg in parents_with_children
 
         subpkg_dict = {
             "type": "package",  
@@ -233,11 +714,6 @@ def get_packages(package_name: str):
         }
         result["packages"].append(subpkg_dict)
 
-        subpkg_classes = session.query(UMLClass).filter(UMLClass.package_name == full_pkg).all()
-        for cls in subpkg_classes:
-            fqcn = f"{cls.package_name}.{cls.name}"
-            package_scope_class_map[fqcn] = cls.package_name
-
     # 3. Add only current package’s own classes
     for cls in classes:
         result["classes"].append({
@@ -248,25 +724,21 @@ def get_packages(package_name: str):
             "package": cls.package_name or ""
         })
 
-    # 4. Elevate class-level relationships to package-level
-    all_relationships = session.query(UMLRelationship).all()
-    seen_package_pairs = set()
-
-    for r in all_relationships:
-        src_pkg = package_scope_class_map.get(r.source)
-        tgt_pkg = package_scope_class_map.get(r.target)
-
-        if src_pkg and tgt_pkg and src_pkg != tgt_pkg:
-            key = (src_pkg, tgt_pkg)
-            if key not in seen_package_pairs:
-                seen_package_pairs.add(key)
-                result["relationships"].append({
-                    "id": f"{src_pkg}->{tgt_pkg}",
-                    "label": r.name or "",
-                    "source": src_pkg,
-                    "target": tgt_pkg,
-                    "type": r.type
-                })
-
-    session.close()
-    return result
\ No newline at end of file
+    # 4. Package-level edges between packages in scope, from the precomputed rollup
+    if not dependencies:
+        return result
+    package_edges = session.query(UMLPackageDependency).filter(
+        UMLPackageDependency.source_package.in_(scope_packages),
+        UMLPackageDependency.target_package.in_(scope_packages)
+    ).order_by(UMLPackageDependency.first_relationship_id).all()
+
+    for dep in package_edges:
+        result["relationships"].append({
+            "id": f"{dep.source_package}->{dep.target_package}",
+            "label": dep.label,
+            "source": dep.source_package,
+            "target": dep.target_package,
+            "type": dep.type
+        })
+
+    return result
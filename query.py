@@ -1,28 +1,41 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import os
 import json
-import subprocess
 import logging
 
 from dotenv import load_dotenv
 from typing import List, Optional, Dict, Literal
-from sqlalchemy import create_engine, text
 from typing_extensions import Annotated, TypedDict
 
 from langchain_groq import ChatGroq
 from langchain_ollama import ChatOllama
 from langgraph.graph import END, StateGraph
-from langgraph.types import Command
+from langgraph.types import Command, Send
 from langgraph.prebuilt import create_react_agent
 from langchain_core.tools import tool
 from langchain_core.messages import HumanMessage, AIMessage
+from common import guarded_page, agent_engine, diagram_digest, diagram_context
+from history_index import update_history_index
+from git_backend import read_object_page, git_command_output
+from change_impact import method_impact
 
 # ## Shared and Utilities
 load_dotenv()
 # ### Updated State Model with Iteration Fields and Full Diagram Context
 
+# Required agents run in parallel, so their answers are merged into the state
+# rather than overwritten; the orchestrator passes None to start a new round.
+def merge_responses(current: Optional[Dict[str, str]], update: Optional[Dict[str, str]]) -> Dict[str, str]:
+    if update is None:
+        return {}
+    return {**(current or {}), **update}
+
+def add_responded(current: Optional[List[str]], update: Optional[List[str]]) -> List[str]:
+    if update is None:
+        return []
+    return (current or []) + update
+
 class LaPSuMState(TypedDict):
     # User query and orchestration context
     user_query: Annotated[Optional[str], "Original user query"]
@@ -31,13 +44,14 @@ class LaPSuMState(TypedDict):
     # Source-related metadata
     repo_path: Annotated[Optional[str], "Path to the local git repository"]
     diagram: Annotated[Optional[str], "Current UML diagram in JSON format"]
+    diagram_digest: Annotated[Optional[dict], "Compact digest of the diagram, built once per question"]
 
     # Agent coordination
     required_agents: Annotated[List[Literal["history", "source_code"]], "List of agents needed to process the query"]
-    responded_agents: Annotated[List[Literal["history", "source_code"]], "List of agents that have already responded"]
+    responded_agents: Annotated[List[Literal["history", "source_code"]], "List of agents that have already responded", add_responded]
 
     # Optional: store intermediate responses for aggregation
-    agent_responses: Annotated[Dict[str, str], "Responses from each agent keyed by agent name"]
+    agent_responses: Annotated[Dict[str, str], "Responses from each agent keyed by agent name", merge_responses]
 
     # Iteration control
     iteration_count: Annotated[int, "Current iteration count"]
@@ -59,6 +73,24 @@ llms = {
     "discussion": qwen
 }
 
+# ### Diagram Context
+
+# Each prompt gets the part of the diagram relevant to its query, with the
+# detail its reader needs: members for SQL, files for git, neither for planning.
+DIAGRAM_VIEWS = {
+    "orchestrator": {"members": False},
+    "history": {"members": False, "files": True},
+    "source_code": {"members": True},
+    "aggregator": {"members": True},
+}
+
+def relevant_diagram(state: LaPSuMState, query: str, agent: str) -> str:
+    return diagram_context(state.get("diagram_digest"), query, **DIAGRAM_VIEWS[agent])
+
+def compact_diagram_node(state: LaPSuMState) -> Command[Literal["orchestrator"]]:
+    # Runs once per question; the agents only ever see the digest
+    return Command(update={"diagram_digest": diagram_digest(state.get("diagram"))}, goto="orchestrator")
+
 # ## Agents and Tools
 
 # ### History Agent
@@ -68,23 +100,40 @@ def run_git_command(repo_path: str, command: str) -> str:
     """
     Run an arbitrary git command in the given repository path.
     """
-    if not os.path.exists(os.path.join(repo_path, ".git")):
-        return f"Error: {repo_path} is not a valid Git repository."
-    try:
-        result = subprocess.run(
-            ["git"] + command.strip().split(),
-            cwd=repo_path,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        return f"Error running git command: {e.stderr}"
+    return git_command_output(repo_path, command)
+
+# The git history index (see history_index.py) is attached to the agents' engine of the UML data
+history_engine = agent_engine("uml-data.db")
+
+@tool
+def query_git_history(sql: str, offset: int = 0) -> str:
+    """Run a SQL query against the indexed git history. Return results as a table, one page at a time from `offset`."""
+    with history_engine.connect() as conn:
+        try:
+            return guarded_page(conn, sql, offset)
+        except Exception as e:
+            return f"SQL Error: {e}"
+
+@tool
+def read_git_object(repo_path: str, revision: str, path: str = "", offset: int = 0) -> str:
+    """
+    Read a git object: a commit with its full message, a tree listing, or the
+    contents of `path` at `revision`. Returns one page of lines from `offset`.
+    """
+    return read_object_page(repo_path, revision, path, offset)
+
+@tool
+def methods_changed(repo_path: str, revisions: str) -> str:
+    """
+    The UML methods and classes (uml_method.id, uml_class.id) whose source
+    lines the commits in `revisions` changed, e.g. 'HEAD~10..HEAD' or
+    'v1.0..v2.0', with how many commits and hunks touched each.
+    """
+    return method_impact(repo_path, revisions)
 
 history_agent = create_react_agent(
     llms['history'],
-    tools=[run_git_command],
+    tools=[query_git_history, read_git_object, methods_changed, run_git_command],
     prompt="""
         You are a version control analysis assistant collaborating with a software researcher.
         Your role is to analyze the Git history of a local project using only the tools provided.
@@ -92,52 +141,70 @@ history_agent = create_react_agent(
         - Do not rely on prior knowledge or assumptions.
         - All information must be derived from Git history via the provided tools.
         - Begin your final answer with 'FINAL ANSWER'.
-        Available Tool:
-        - run_git_command(command): Run any git command against the local repo.
+        Available Tools:
+        - query_git_history(sql, offset): SQL over the indexed history, answers in milliseconds. Prefer it.
+          Results are paged; pass offset to read more rows. Tables:
+          - git_commit(sha, parents, author_name, author_email, authored_at, committed_at, subject)
+          - git_file_change(id, sha, path, old_path, added, deleted): one row per file a commit touched;
+            old_path is set for renames, added/deleted are NULL for binary files
+          - git_file_churn(path, commits, added, deleted, authors, first_committed_at, last_committed_at)
+          - uml_class_churn(class_id, commits, authors, added, deleted, churned, first_committed_at,
+            last_committed_at): the same per UML class (join uml_class.id), over the class's source files
+          Times are unix seconds: use datetime(committed_at, 'unixepoch').
+        - read_git_object(revision, path, offset): A commit's full message, a tree listing, or a file's
+          contents at a revision, paged by lines. Use it instead of git show.
+        - methods_changed(revisions): The uml_method/uml_class ids whose lines a commit range changed,
+          from the diff hunks. Use it for which methods or classes a change touched instead of reading diffs.
+        - run_git_command(command): Run any git command against the local repo, for what the index
+          does not hold (diff contents, blame).
         Always refer to the repo using the path provided in 'repo_path'.
     """
 )
 
-def history_node(state: LaPSuMState) -> Command[Literal["orchestrator"]]:
+def history_node(state: LaPSuMState) -> Command[Literal["aggregator"]]:
     if "history" in state.get("responded_agents", []):
-        return Command(update=state, goto="orchestrator")
+        return Command(goto="aggregator")
     
-    # Build the query and append the full diagram data
+    # Build the query and append the relevant part of the diagram
     base_query = state.get("rewritten_query") or state.get("user_query") or ""
-    diagram_context = "\n\nDiagram Data:\n" + state["diagram"] if state.get("diagram") else ""
-    full_query = base_query + diagram_context
+    diagram_data = relevant_diagram(state, base_query, "history")
+    full_query = base_query + ("\n\nDiagram Data:\n" + diagram_data if diagram_data else "")
 
     repo_path = state.get("repo_path")
+    if repo_path:
+        try:
+            update_history_index(repo_path)
+        except Exception as e:
+            logging.warning("Could not index the git history of %s: %s", repo_path, e)
     result = history_agent.invoke({
         "messages": [HumanMessage(content=full_query)],
         "repo_path": repo_path,
     })
 
     final_message = result["messages"][-1]
-    state["agent_responses"]["history"] = final_message.content
-    state["responded_agents"].append("history")
     result["messages"][-1] = AIMessage(content=final_message.content, name="history")
-    return Command(update=state, goto="orchestrator")
+    return Command(update={
+        "agent_responses": {"history": final_message.content},
+        "responded_agents": ["history"],
+    }, goto="aggregator")
 
 # ### Source Code Agent
 
-engine = create_engine("sqlite:///uml-data.db")
+engine = agent_engine("uml-data.db")
 
 @tool
-def query_uml_database(sql: str) -> str:
-    """Run a SQL query against the UML database. Return results as string."""
+def query_uml_database(sql: str, offset: int = 0) -> str:
+    """Run a SQL query against the UML database. Return results as a table, one page at a time from `offset`."""
     with engine.connect() as conn:
         try:
-            result = conn.execute(text(sql))
-            rows = [dict(row) for row in result]
-            return str(rows)
+            return guarded_page(conn, sql, offset)
         except Exception as e:
             return f"SQL Error: {e}"
 
 SCHEMA_PROMPT = """
 You are a software architecture assistant specialized in analyzing Java projects via UML databases.
 You can use the following tool:
-- query_uml_database(sql): Run SQL queries on the UML database.
+- query_uml_database(sql, offset): Run SQL queries on the UML database. Results are paged; pass offset to read more rows.
 The UML schema consists of:
 - uml_class(id, name, package_name, is_abstract, is_interface, annotations, files, dom_id, display_name, summary, comments)
 - uml_property(id, class_id, name, data_type, visibility, is_static, is_final, source_line, dom_id, annotations, comments, summary)
@@ -145,7 +212,7 @@ The UML schema consists of:
 - uml_parameter(id, method_id, name, dom_id, data_type, display_name, annotations, comments, summary)
 - uml_relationship(id, name, dom_id, source, target, type)
 - uml_package(id, name, parent)
-When generating SQL queries, consider the full diagram data provided.
+When generating SQL queries, consider the diagram data provided.
 """
 
 uml_agent = create_react_agent(
@@ -154,21 +221,22 @@ uml_agent = create_react_agent(
     prompt=SCHEMA_PROMPT,
 )
 
-def source_code_node(state: LaPSuMState) -> Command[Literal["orchestrator"]]:
+def source_code_node(state: LaPSuMState) -> Command[Literal["aggregator"]]:
     if "source_code" in state.get("responded_agents", []):
-        return Command(update=state, goto="orchestrator")
+        return Command(goto="aggregator")
     
-    # Build query with full diagram data included
+    # Build query with the relevant part of the diagram included
     base_query = state.get("rewritten_query") or state.get("user_query") or ""
-    diagram_context = "\n\nDiagram Data:\n" + state["diagram"] if state.get("diagram") else ""
-    full_query = base_query + diagram_context
+    diagram_data = relevant_diagram(state, base_query, "source_code")
+    full_query = base_query + ("\n\nDiagram Data:\n" + diagram_data if diagram_data else "")
 
     result = uml_agent.invoke({"messages": [HumanMessage(content=full_query)]})
     final_message = result["messages"][-1]
-    state["agent_responses"]["source_code"] = final_message.content
-    state["responded_agents"].append("source_code")
     result["messages"][-1] = AIMessage(content=final_message.content, name="source_code")
-    return Command(update=state, goto="orchestrator")
+    return Command(update={
+        "agent_responses": {"source_code": final_message.content},
+        "responded_agents": ["source_code"],
+    }, goto="aggregator")
 
 # ### Aggregator Agent
 
@@ -185,7 +253,7 @@ aggregator_agent = create_react_agent(
         - DO NOT make assumptions or guesses.
         - If the information is incomplete or missing, say so directly.
         - If the answer is complete, prefix your final output with: 'FINAL ANSWER'.
-        Be sure to consider the full diagram data provided.
+        Be sure to consider the diagram data provided.
     """
 )
 
@@ -193,12 +261,14 @@ def aggregator_node(state: LaPSuMState) -> Command[Literal["orchestrator", END]]
     # If any previous response already has a final answer, end the workflow.
     for response in state.get("agent_responses", {}).values():
         if "FINAL ANSWER" in response:
-            return Command(update=state, goto=END)
+            return Command(goto=END)
     
-    # Build conversation context including the full diagram data.
-    messages = [HumanMessage(content=state["rewritten_query"] or state["user_query"])]
-    if state.get("diagram"):
-        messages.insert(0, HumanMessage(content="Full Diagram Data:\n" + state["diagram"], name="diagram"))
+    # Build conversation context including the relevant part of the diagram.
+    query = state["rewritten_query"] or state["user_query"]
+    messages = [HumanMessage(content=query)]
+    diagram_data = relevant_diagram(state, query, "aggregator")
+    if diagram_data:
+        messages.insert(0, HumanMessage(content="Diagram Data:\n" + diagram_data, name="diagram"))
     for agent_name in state.get("required_agents", []):
         if agent_name in state.get("agent_responses", {}):
             messages.append(AIMessage(
@@ -208,30 +278,32 @@ def aggregator_node(state: LaPSuMState) -> Command[Literal["orchestrator", END]]
     
     result = aggregator_agent.invoke({"messages": messages})
     final_message = result["messages"][-1]
-    goto = END if "FINAL ANSWER" in final_message.content else "orchestrator"
-    state["agent_responses"]["aggregator"] = final_message.content
-    return Command(update=state, goto=goto)
+    # Once the iteration budget is spent the orchestrator would only hand back here, so end with this attempt
+    budget_spent = state.get("iteration_count", 0) >= state.get("max_iterations", 10)
+    goto = END if "FINAL ANSWER" in final_message.content or budget_spent else "orchestrator"
+    return Command(update={"agent_responses": {"aggregator": final_message.content}}, goto=goto)
 
 # ### Orchestrator Node
 
 def orchestrator_node(state: LaPSuMState) -> Command[Literal["history", "source_code", "aggregator"]]:
     # Check if maximum iterations have been reached.
     if state.get("iteration_count", 0) >= state.get("max_iterations", 10):
-        return Command(update=state, goto="aggregator")
+        return Command(goto="aggregator")
     
     # Increment iteration counter.
-    state["iteration_count"] = state.get("iteration_count", 0) + 1
+    update = {"iteration_count": state.get("iteration_count", 0) + 1}
     
     # Retrieve any previous aggregator attempt.
     previous_attempt = state.get("agent_responses", {}).get("aggregator")
     additional_context = f"Previous attempt: {previous_attempt}\n" if previous_attempt else ""
     
-    # Include the full diagram data in the orchestrator prompt.
-    diagram_context = "Full Diagram Data:\n" + state["diagram"] + "\n" if state.get("diagram") else ""
+    # Include the part of the diagram relevant to the user query in the orchestrator prompt.
+    diagram_data = relevant_diagram(state, state.get("user_query") or "", "orchestrator")
+    diagram_section = "Diagram Data:\n" + diagram_data + "\n" if diagram_data else ""
     
     # If all required agents have responded, trigger aggregation.
-    if state.get("user_query") is None or set(state.get("required_agents", [])) == set(state.get("responded_agents", [])):
-        return Command(update=state, goto="aggregator")
+    if state.get("user_query") is None or (state.get("required_agents") and set(state["required_agents"]) == set(state.get("responded_agents", []))):
+        return Command(update=update, goto="aggregator")
     
     # Use the orchestrator LLM to rewrite the query and plan next steps.
     task_analysis = llms['orchestrator'].invoke([
@@ -243,7 +315,7 @@ def orchestrator_node(state: LaPSuMState) -> Command[Literal["history", "source_
                 "- 'history': analyzes git history, commit changes, authorship, file evolution.\n\n"
                 f"User Query: {state['user_query']}\n"
                 f"{additional_context}"
-                f"{diagram_context}\n"
+                f"{diagram_section}\n"
                 "Respond in JSON format like this:\n"
                 "{\n"
                 '  "rewritten_query": "....",\n'
@@ -258,38 +330,35 @@ def orchestrator_node(state: LaPSuMState) -> Command[Literal["history", "source_
         parsed_response = json.loads(task_analysis.content)
     except json.JSONDecodeError as e:
         logging.error("JSON decode error in orchestrator: %s", e)
-        return Command(update=state, goto="aggregator")
+        return Command(update=update, goto="aggregator")
     
-    state["rewritten_query"] = parsed_response.get("rewritten_query", state["user_query"])
-    state["required_agents"] = parsed_response.get("required_agents", [])
+    update["rewritten_query"] = parsed_response.get("rewritten_query", state["user_query"])
+    update["required_agents"] = parsed_response.get("required_agents", [])
     # Reset responses for the new iteration while preserving iteration_count and diagram data.
-    state["responded_agents"] = []
-    state["agent_responses"] = {}
-    
-    plan = parsed_response.get("plan")
-    if plan:
-        plan_message = HumanMessage(content=f"Plan:\n{plan}", name="planner")
-        state["messages"] = [plan_message] + state.get("messages", [])
+    update["responded_agents"] = None
+    update["agent_responses"] = None
     
-    if not state["required_agents"]:
-        return Command(update=state, goto="aggregator")
+    if not update["required_agents"]:
+        return Command(update=update, goto="aggregator")
     
-    next_agent = state["required_agents"][0]
-    return Command(update=state, goto=next_agent)
+    # Dispatch every required agent at once; they all return to the aggregator,
+    # which runs once the slowest of them has answered.
+    task = {**state, **update, "responded_agents": [], "agent_responses": {}}
+    return Command(update=update, goto=[Send(agent, task) for agent in update["required_agents"]])
 
 # ## Graph Setup
 
 workflow = StateGraph(LaPSuMState)
+workflow.add_node("compact_diagram", compact_diagram_node)
 workflow.add_node("orchestrator", orchestrator_node)
 workflow.add_node("aggregator", aggregator_node)
 workflow.add_node("history", history_node)
 workflow.add_node("source_code", source_code_node)
 
-workflow.set_entry_point("orchestrator")
-workflow.add_edge("source_code", "orchestrator")
-workflow.add_edge("history", "orchestrator")
-workflow.add_edge("aggregator", "orchestrator")
-workflow.add_edge("aggregator", END)
+# Every node routes itself with Command: the diagram is compacted once, then
+# the orchestrator fans out to the required agents, they join at the
+# aggregator, which ends or re-plans.
+workflow.set_entry_point("compact_diagram")
 
 graph = workflow.compile()
 
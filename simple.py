@@ -1,16 +1,148 @@
+import os
+import gzip
+import logging
+import threading
 import json
+import orjson
+import asyncio
 import uvicorn
-from fastapi import FastAPI, WebSocket, Query
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 
 from typing import Optional
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from starlette.websockets import WebSocketState
 from langgraph.graph import StateGraph, START, END
 from langchain_ollama import ChatOllama
+from langchain_core.messages import AIMessageChunk
 from pydantic import BaseModel
-from graph import db_app
+from graph import db_fast_app, sql_cancelled, question_prompt, final_answer, lookup_answer, remember_answer
+from model import get_classes, get_packages, iter_classes, parse_fields, migrate_schema, ensure_package_rollup, engine, Session, db_version
+from cache import ResponseCache, etag_matches, accepts_encoding
+from snapshot import SNAPSHOT_ENCODING, encode_payload, ensure_snapshots, load_snapshot
 
-app = FastAPI()
+# SQLAlchemy calls are synchronous; they run on this bounded pool so a slow
+# package never stalls the event loop serving other HTTP and websocket clients.
+DB_WORKERS = int(os.getenv("DB_WORKERS", "8"))
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="uml-db")
+
+async def run_db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(db_executor, fn, *args)
+
+def encode_data(fn, *args):
+    # Encoding the payload is as costly as building it, so it stays on the worker too
+    return encode_payload(fn(*args))
+
+# The UML DB only changes between ingestions, so encoded payloads are cached
+# per (endpoint, package, DB version) and revalidated by ETag.
+response_cache = ResponseCache(max_bytes=int(os.getenv("RESPONSE_CACHE_BYTES", str(64 * 1024 * 1024))))
+pending_builds = {}
+
+async def cached_data_response(request: Request, endpoint: str, fn, *args):
+    version = db_version()
+    etag = response_cache.etag(endpoint, args, version)
+    headers = {"Cache-Control": "no-cache"}
+    key = (endpoint, args, version)
+
+    # The default view (package only) is served from its pre-rendered snapshot when there is one
+    snapshot = None
+    if all(arg is None for arg in args[1:]):
+        snapshot_key = key + (SNAPSHOT_ENCODING,)
+        snapshot = response_cache.get(snapshot_key)
+        if snapshot is None:
+            # b"" remembers that there is no snapshot for this version
+            snapshot = await run_db(load_snapshot, endpoint, args[0]) or b""
+            response_cache.put(snapshot_key, snapshot)
+    encoded = bool(snapshot) and accepts_encoding(request.headers.get("accept-encoding"), SNAPSHOT_ENCODING)
+    if snapshot:
+        headers["Vary"] = "Accept-Encoding"
+    if encoded:
+        # The compressed body differs byte for byte from the identity one, so it gets its own strong ETag
+        etag = f'{etag[:-1]}-{SNAPSHOT_ENCODING}"'
+    headers["ETag"] = etag
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if encoded:
+        headers["Content-Encoding"] = SNAPSHOT_ENCODING
+        return Response(content=snapshot, media_type="application/json", headers=headers)
+
+    body = response_cache.get(key)
+    if body is None:
+        # Concurrent misses for the same key share a single build
+        pending = pending_builds.get(key)
+        if pending is None:
+            build = (gzip.decompress, snapshot) if snapshot else (encode_data, fn, *args)
+            pending = asyncio.ensure_future(run_db(*build))
+            pending_builds[key] = pending
+            pending.add_done_callback(lambda _: pending_builds.pop(key, None))
+        body = await asyncio.shield(pending)
+        response_cache.put(key, body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# === Streaming class dumps ===
+
+def ndjson_pieces(items):
+    # One {"class": {...}} or {"relationship": {...}} object per line
+    for kind, item in items:
+        yield orjson.dumps({kind: item}, option=orjson.OPT_APPEND_NEWLINE)
+
+def json_pieces(items):
+    # Same outer shape as /data/classes, written out incrementally
+    yield b'{"data":{"type":"class","classes":['
+    section, first = "class", True
+    for kind, item in items:
+        if kind != section:
+            yield b'],"relationships":['
+            section, first = kind, True
+        yield orjson.dumps(item) if first else b"," + orjson.dumps(item)
+        first = False
+    if section == "class":
+        yield b'],"relationships":['
+    yield b']}}'
+
+def chunked(pieces, chunk_bytes=64 * 1024):
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_bytes:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+async def iterate_on_db_pool(chunks):
+    # Each chunk is produced on the DB worker pool, never on the event loop
+    done = object()
+    try:
+        while (chunk := await run_db(next, chunks, done)) is not done:
+            yield chunk
+    finally:
+        chunks.close()
+
+
+def log_snapshot_failure(future):
+    # Nothing awaits the background build; without this its failure would go unreported
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Building the snapshots failed", exc_info=future.exception())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Bring uml-data.db up to the current schema version and materialize the
+    # package-dependency rollup before the first request
+    migrate_schema(engine)
+    with Session() as session:
+        ensure_package_rollup(session)
+    # Snapshots of a freshly ingested database are rendered in the background;
+    # the live path answers until they are in
+    snapshots = asyncio.get_running_loop().run_in_executor(db_executor, ensure_snapshots)
+    snapshots.add_done_callback(log_snapshot_failure)
+    yield
+    db_executor.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan)
 
 
 app.add_middleware(
@@ -19,12 +151,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["ETag"],
 )
 
-from model import get_classes, get_packages
 @app.get("/data/classes")
 async def get_classes_data(
+    request: Request,
     package: Optional[str] = Query(None, description="Optional package name to filter classes"),
+    limit: Optional[int] = Query(None, ge=1, description="Page size; enables cursor pagination"),
+    cursor: Optional[int] = Query(None, description="nextCursor of the previous page"),
+    fields: Optional[str] = Query(None, description="Comma-separated projection, e.g. id,name,methods.name"),
     # filter: Optional[str] = Query(None, description="Optional filter object")
 ):
     """
@@ -32,12 +168,18 @@ async def get_classes_data(
     
     Query Parameters:
     - package (optional): Package name to filter UML classes
+    - limit, cursor (optional): Page through classes in id order; the response carries nextCursor
+    - fields (optional): Class fields to return, plus "relationships"
     """
-    data = get_classes(package or None)
-    return {"data": data}
+    try:
+        parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await cached_data_response(request, "classes", get_classes, package or None, limit, cursor, fields or None)
 
 @app.get("/data/packages")
 async def get_packages_data(
+    request: Request,
     package: Optional[str] = Query(None, description="Optional package name to filter classes"),
     # filter: Optional[str] = Query(None, description="Optional filter object")
 ):
@@ -47,34 +189,159 @@ async def get_packages_data(
     Query Parameters:
     - package (optional): Package name to filter UML classes
     """
-    data = get_packages(package or None)
-    return {"data": data}
+    return await cached_data_response(request, "packages", get_packages, package or None)
 
+@app.get("/data/classes/stream")
+async def stream_classes_data(
+    package: Optional[str] = Query(None, description="Optional package name to filter classes"),
+    format: str = Query("ndjson", pattern="^(ndjson|json)$", description="ndjson, or json shaped like /data/classes"),
+):
+    """
+    Stream the classes and then the relationships of a package, or of the whole
+    repository, without building the payload in memory.
+    
+    Query Parameters:
+    - package (optional): Package name to filter UML classes
+    - format (optional): "ndjson" (default) or "json"
+    """
+    items = iter_classes(package or None)
+    if format == "ndjson":
+        return StreamingResponse(iterate_on_db_pool(chunked(ndjson_pieces(items))), media_type="application/x-ndjson")
+    return StreamingResponse(iterate_on_db_pool(chunked(json_pieces(items))), media_type="application/json")
+
+
+# === Chat ===
+
+def describe_step(node: str, update) -> dict:
+    """What a graph node just did (tables listed, schema fetched, SQL generated or run), for the client."""
+    event = {"status": "step", "node": node}
+    messages = (update or {}).get("messages") or []
+    if messages:
+        last = messages[-1]
+        if getattr(last, "tool_calls", None):
+            event["toolCalls"] = [{"name": tc["name"], "args": tc["args"]} for tc in last.tool_calls]
+        if last.content:
+            event["content"] = last.content if isinstance(last.content, str) else str(last.content)
+    return event
+
+def describe_token(chunk, metadata) -> Optional[dict]:
+    """An LLM token as it arrives; tool-call argument deltas (such as the final answer) included."""
+    if not isinstance(chunk, AIMessageChunk):
+        return None
+    node = metadata.get("langgraph_node")
+    if chunk.content:
+        return {"token": chunk.content, "node": node}
+    args = "".join(tc.get("args") or "" for tc in chunk.tool_call_chunks)
+    if args:
+        return {"token": args, "node": node, "toolCall": True}
+    return None
+
+async def answer_question(send, request_id, question: str, context: str):
+    """
+    Run the SQL agent graph on one question, sending each node transition and
+    the LLM tokens, tagged with `request_id`, as they happen. The graph is
+    driven through its async streaming API, so other questions and connections
+    keep being served meanwhile; cancelling the task aborts the in-flight LLM
+    request and interrupts any SQL statement still running for it.
+
+    Questions asked before are answered from the answer cache.
+    """
+    answer = await run_db(lookup_answer, question, context)
+    if answer is not None:
+        await send({"id": request_id, "final_response": answer, "cached": True})
+        return
+
+    cancelled = threading.Event()
+    sql_cancelled.set(cancelled)
+    inputs = {"messages": [("user", question_prompt(question, context))]}
+    answer = None
+    messages = []
+    try:
+        async for mode, chunk in db_fast_app.astream(inputs, stream_mode=["updates", "messages"]):
+            if mode == "messages":
+                event = describe_token(*chunk)
+                if event:
+                    await send({"id": request_id, **event})
+                continue
+            for node, update in chunk.items():
+                await send({"id": request_id, **describe_step(node, update)})
+                for message in (update or {}).get("messages") or []:
+                    messages.append(message)
+                    answer = final_answer(message) or answer
+    finally:
+        cancelled.set()
+    if answer is None:
+        raise RuntimeError("The agent finished without submitting a final answer")
+    await run_db(remember_answer, question, context, messages, answer)
+    await send({"id": request_id, "final_response": answer})
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time AI chat."""
+    """
+    WebSocket endpoint for real-time AI chat.
+
+    Each {"id", "message", "context"} frame starts a question that runs
+    alongside the others on the connection; every event sent back carries its
+    id. {"id", "cancel": true} stops that question.
+    """
     await websocket.accept()
+    send_lock = asyncio.Lock()
+    questions = {}
+
+    async def send(event):
+        async with send_lock:
+            await websocket.send_text(json.dumps(event, default=str))
+
+    async def run_question(request_id, question, context):
+        try:
+            await answer_question(send, request_id, question, context)
+        except asyncio.CancelledError:
+            if websocket.client_state == WebSocketState.CONNECTED:
+                await send({"id": request_id, "status": "cancelled"})
+        except Exception as e:
+            print("Error:")
+            print(e)
+            await send({"id": request_id, "error": str(e)})
+        finally:
+            questions.pop(request_id, None)
+
     try:
         while True:
             data = await websocket.receive_text()
             user_input = json.loads(data)
+            request_id = user_input.get("id")
+
+            if user_input.get("cancel"):
+                question_task = questions.get(request_id)
+                if question_task:
+                    question_task.cancel()
+                continue
+            if request_id in questions:
+                await send({"id": request_id, "error": "A question with this id is already running"})
+                continue
 
             # Send a "Thinking..." message to client
-            await websocket.send_text(json.dumps({"status": "thinking"}))
+            await send({"id": request_id, "status": "thinking"})
             # Stream the AI response
             question = user_input.get("message", "")
             context  = user_input.get("context", "")
             print(f"User Query: {question} \n \n in the context of \n\n {context}")
-            messages = db_app.invoke( { "messages": [("user", f"User Query: {question} \n \n in the context of \n\n {context}")] } )
-            await websocket.send_text(json.dumps({"final_response": messages["messages"][-1].tool_calls[0]["args"]["final_answer"]}))
+            questions[request_id] = asyncio.create_task(run_question(request_id, question, context))
+    except WebSocketDisconnect:
+        print("Client disconnected")
     except Exception as e:
         print("Error:")
         print(e)
-        await websocket.send_text(json.dumps({"error": str(e)}))
+        await send({"error": str(e)})
     finally:
         print("Closing ")
-        await websocket.close()
+        # Nobody is left to read the answers: stop the LLM and SQL work
+        pending = list(questions.values())
+        for question_task in pending:
+            question_task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if websocket.client_state != WebSocketState.DISCONNECTED:
+            await websocket.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+"""
+Pre-rendered diagram snapshots.
+
+The /data/classes and /data/packages payloads of a package only change when
+uml-data.db does, so they are rendered once per ingestion, gzip-compressed
+and stored in uml_snapshot; simple.py serves those bytes as they are and
+falls back to the live queries for anything without a current snapshot.
+
+    python snapshot.py      # after the extractor has written uml-data.db
+"""
+import gzip
+
+import orjson
+
+from sqlalchemy import select, delete, insert, text, false
+from sqlalchemy.exc import OperationalError
+
+import model
+from model import UMLClass, UMLPackage, UMLSnapshot, UMLRollupState, Session, get_classes, get_packages, ensure_package_rollup
+
+SNAPSHOT_ENCODING = "gzip"
+SNAPSHOT_STATE = "diagram_snapshot"
+
+# Snapshotted endpoints: the default view of each, without pagination or projection
+SNAPSHOT_ENDPOINTS = {"classes": get_classes, "packages": get_packages}
+
+# uml_class and uml_relationship are already covered by the rollup triggers,
+# which mark every uml_rollup_state row dirty
+SNAPSHOT_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_snapshot AFTER {op} ON {table} "
+    f"BEGIN UPDATE uml_rollup_state SET dirty = 1 WHERE name = '{SNAPSHOT_STATE}'; END"
+    for table in ("uml_property", "uml_method", "uml_parameter", "uml_package")
+    for op in ("INSERT", "UPDATE", "DELETE")
+]
+
+def encode_payload(data) -> bytes:
+    """The JSON body served for an endpoint's `data`, byte for byte (compact UTF-8, stored JSON spliced raw)."""
+    return orjson.dumps({"data": data})
+
+def snapshot_packages(session):
+    """Every package a diagram view can be opened on, "" standing for the root."""
+    names = {""}
+    names.update(session.execute(select(UMLClass.package_name).where(UMLClass.package_name.is_not(None)).distinct()).scalars())
+    for name, parent in session.execute(select(UMLPackage.name, UMLPackage.parent)):
+        names.add(f"{parent}.{name}" if parent else name)
+    return sorted(names)
+
+def build_snapshots(compresslevel: int = 9):
+    """
+    Render and store the snapshot of every endpoint for every package.
+
+    Old snapshots are dropped and the state is marked current before
+    rendering, so a write to the database during the build marks the new
+    snapshots stale again instead of being lost. Returns the snapshot count.
+    """
+    with Session() as session:
+        # Rebuilding the rollup re-links relationships, which would mark the snapshots dirty
+        ensure_package_rollup(session)
+        model.Base.metadata.create_all(session.get_bind(), tables=[UMLSnapshot.__table__, UMLRollupState.__table__])
+        for trigger in SNAPSHOT_TRIGGERS:
+            session.execute(text(trigger))
+        session.execute(delete(UMLSnapshot))
+        session.merge(UMLRollupState(name=SNAPSHOT_STATE, dirty=False))
+        session.commit()
+        packages = snapshot_packages(session)
+
+    rows = [
+        {
+            "endpoint": endpoint,
+            "package": package,
+            "body": gzip.compress(encode_payload(fn(package or None)), compresslevel=compresslevel, mtime=0)
+        }
+        for package in packages
+        for endpoint, fn in SNAPSHOT_ENDPOINTS.items()
+    ]
+    with Session() as session:
+        session.execute(insert(UMLSnapshot), rows)
+        session.commit()
+    return len(rows)
+
+def snapshots_are_current(session):
+    try:
+        dirty = session.execute(
+            select(UMLRollupState.dirty).where(UMLRollupState.name == SNAPSHOT_STATE)
+        ).scalar_one_or_none()
+    except OperationalError:
+        session.rollback()
+        return False
+    return dirty is not None and not dirty
+
+def ensure_snapshots():
+    """Build the snapshots if there are none or the database changed since they were built."""
+    with Session() as session:
+        if snapshots_are_current(session):
+            return 0
+    return build_snapshots()
+
+def load_snapshot(endpoint: str, package: str):
+    """Compressed body of `endpoint` for `package`, or None if there is no current snapshot."""
+    current = select(UMLRollupState.dirty).where(UMLRollupState.name == SNAPSHOT_STATE).scalar_subquery()
+    with Session() as session:
+        try:
+            return session.execute(
+                select(UMLSnapshot.body)
+                .where(UMLSnapshot.endpoint == endpoint, UMLSnapshot.package == (package or ""), current == false())
+            ).scalar_one_or_none()
+        except OperationalError:
+            return None
+
+
+if __name__ == "__main__":
+    model.migrate_schema(model.engine)
+    print(f"{build_snapshots()} snapshots written")